@@ -0,0 +1,68 @@
+import sys, os, struct, timeit, argparse, tempfile, grope
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from otf_tools import font
+
+def _otf_table_checksum_chunked(b):
+    # The original implementation, kept as the reference.
+    r = 0
+    while b:
+        chunk_len = min(len(b), 16*1024)
+        if chunk_len < 4:
+            item,  = struct.unpack('>I', bytes(b) + font._pad4(len(b)))
+            r += item
+            break
+
+        chunk_len = chunk_len & ~3
+        items = struct.unpack('>{}I'.format(chunk_len // 4), bytes(b[:chunk_len]))
+
+        r = (r + sum(items)) & 0xffffffff
+        b = b[chunk_len:]
+
+    return r & 0xffffffff
+
+def _main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--sizes', type=int, nargs='+', default=[1, 4, 16, 64], help='buffer sizes in MiB')
+    ap.add_argument('--repeat', type=int, default=3)
+    args = ap.parse_args()
+
+    engines = [('chunked', _otf_table_checksum_chunked)]
+    if font.numpy is not None:
+        engines.append(('numpy', font._otf_table_checksum))
+
+    def no_numpy(b):
+        saved_numpy, font.numpy = font.numpy, None
+        try:
+            return font._otf_table_checksum(b)
+        finally:
+            font.numpy = saved_numpy
+    engines.append(('array', no_numpy))
+
+    print('{:>6} {:>6} {}'.format('MiB', 'source', ' '.join('{:>10}'.format(name + ' MB/s') for name, fn in engines)))
+    for size in args.sizes:
+        data = os.urandom(size * 1024 * 1024 + 2)
+
+        with tempfile.TemporaryFile() as fin:
+            fin.write(data)
+            sources = [('bytes', data), ('file', grope.wrap_io(fin)[2:])]
+
+            expected = _otf_table_checksum_chunked(data[2:])
+            for source_name, source in sources:
+                if source_name == 'bytes':
+                    source = grope.rope(data)[2:]
+
+                speeds = []
+                for name, fn in engines:
+                    if fn(source) != expected:
+                        raise RuntimeError('{} checksum mismatch'.format(name))
+                    t = min(timeit.repeat(lambda: fn(source), number=1, repeat=args.repeat))
+                    speeds.append(len(source) / t / 1e6)
+
+                print('{:>6} {:>6} {}'.format(size, source_name, ' '.join('{:>10.1f}'.format(speed) for speed in speeds)))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,117 @@
+import sys, os, struct, math, random, timeit, argparse, six
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from otf_tools import cmap
+
+def _parse_format4_loop(blob, offs):
+    # The original per-codepoint decoder, kept as the reference.
+    length, = struct.unpack('>H', bytes(blob[offs+2:offs+4]))
+    blob = bytes(blob[offs:offs+length])
+
+    seg_count = struct.unpack('>H', blob[6:8])[0] // 2
+    words = struct.unpack('>{}H'.format((length - 14) // 2), blob[14:])
+
+    end_count = words[:seg_count]
+    start_count = words[seg_count + 1:2*seg_count + 1]
+    id_delta = words[2*seg_count + 1:3*seg_count + 1]
+    id_range_offset = words[3*seg_count + 1:4*seg_count + 1]
+    glyph_ids = words[4*seg_count + 1:]
+
+    r = [0] * 0x10000
+    for sid in six.moves.range(seg_count):
+        if id_range_offset[sid] == 0:
+            for cid in six.moves.range(start_count[sid], end_count[sid] + 1):
+                r[cid] = (cid + id_delta[sid])  % 0x10000
+        else:
+            adj = start_count[sid] + seg_count - sid - id_range_offset[sid] // 2
+            for cid in six.moves.range(start_count[sid], end_count[sid] + 1):
+                glyph = glyph_ids[cid - adj]
+                if glyph != 0:
+                    glyph += id_delta[sid]
+                r[cid] = glyph % 0x10000
+    return r
+
+def _lookup_sample(segments):
+    # What a typical worker does: parse the subtable and look up a few characters.
+    for cid in six.moves.range(0x4e00, 0x4e00 + 100):
+        segments.lookup(cid)
+
+def make_format4(rng, scatter):
+    '''
+    Builds a CJK-style format 4 subtable: ASCII and Latin as delta segments,
+    the URO block (U+4E00..U+9FFF) split into segments, a `scatter` fraction
+    of which use the glyph id array.
+    '''
+
+    segments = [(0x20, 0x7e, (1 - 0x20) & 0xffff, None), (0xa0, 0x24f, (96 - 0xa0) & 0xffff, None)]
+
+    next_gid = 1000
+    cid = 0x4e00
+    while cid < 0xa000:
+        end = min(0x9fff, cid + rng.randrange(8, 1024))
+        if rng.random() < scatter:
+            glyphs = [rng.randrange(1, 0xfffe) for _ in six.moves.range(end - cid + 1)]
+            segments.append((cid, end, rng.choice((0, rng.randrange(1, 0x10000))), glyphs))
+        else:
+            segments.append((cid, end, (next_gid - cid) & 0xffff, None))
+        next_gid += end - cid + 1
+        cid = end + 1
+
+    segments.append((0xffff, 0xffff, 1, None))
+
+    seg_count = len(segments)
+    glyph_array = []
+    id_range_offset = []
+    for sid, (start, end, delta, glyphs) in enumerate(segments):
+        if glyphs is None:
+            id_range_offset.append(0)
+        else:
+            id_range_offset.append(2 * (seg_count - sid + len(glyph_array)))
+            glyph_array.extend(glyphs)
+
+    words = [end for start, end, delta, glyphs in segments]
+    words.append(0)
+    words.extend(start for start, end, delta, glyphs in segments)
+    words.extend(delta for start, end, delta, glyphs in segments)
+    words.extend(id_range_offset)
+    words.extend(glyph_array)
+
+    entry_selector = int(math.floor(math.log2(seg_count)))
+    search_range = 2 * 2**entry_selector
+    return struct.pack('>7H{}H'.format(len(words)),
+        4, 14 + 2*len(words), 0, 2*seg_count, search_range, entry_selector, 2*seg_count - search_range, *words)
+
+def _main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--repeat', type=int, default=5)
+    ap.add_argument('--seed', type=int, default=0)
+    args = ap.parse_args()
+
+    rng = random.Random(args.seed)
+
+    print('{:>8} {:>8} {:>10} {:>10} {:>10} {:>8} {:>10}'.format('scatter', 'bytes', 'loop ms', 'batch ms', 'no-numpy', 'speedup', 'lazy ms'))
+    for scatter in (0.0, 0.25, 0.5, 1.0):
+        blob = make_format4(rng, scatter)
+
+        expected = _parse_format4_loop(blob, 0)
+        if list(cmap._parse_format4(blob, 0).dense()) != expected:
+            raise RuntimeError('batched decoder disagrees with the reference loop')
+
+        loop = min(timeit.repeat(lambda: _parse_format4_loop(blob, 0), number=1, repeat=args.repeat))
+        batch = min(timeit.repeat(lambda: cmap._parse_format4(blob, 0).dense(), number=1, repeat=args.repeat))
+        lazy = min(timeit.repeat(lambda: _lookup_sample(cmap._parse_format4(blob, 0)), number=1, repeat=args.repeat))
+
+        saved_numpy, cmap.numpy = cmap.numpy, None
+        try:
+            fallback = min(timeit.repeat(lambda: cmap._parse_format4(blob, 0).dense(), number=1, repeat=args.repeat))
+        finally:
+            cmap.numpy = saved_numpy
+
+        print('{:>8} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>7.1f}x {:>10.2f}'.format(
+            scatter, len(blob), loop * 1000, batch * 1000, fallback * 1000, loop / batch, lazy * 1000))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(_main())
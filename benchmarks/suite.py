@@ -0,0 +1,156 @@
+import sys, os, io, gc, json, time, platform, argparse, tracemalloc, tempfile, shutil, atexit, grope
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from otf_tools import OpenTypeFont, FontCache, font as font_module
+import synthetic
+
+def _parsed(sf):
+    return OpenTypeFont.parse(io.BytesIO(sf.data))
+
+def _with_gsub(sf):
+    font = _parsed(sf)
+    font.get(b'GSUB')
+    return font
+
+def _warm(sf):
+    font = _parsed(sf)
+    font.get(b'cmap')
+    font.get(b'GSUB').make_subber(sf.features)
+    return font
+
+def _shaped(sf):
+    font = _warm(sf)
+    return font, font.get_glyphs(sf.text, sf.features)
+
+def _glyph_runs(sf):
+    # The shaped text cut into runs, as text extraction sees it.
+    font, gids = _shaped(sf)
+    return font, [gids[idx:idx + 20] for idx in range(0, len(gids), 20)]
+
+def _short_texts(sf):
+    # The sample text cut into short strings, as in batch shaping jobs.
+    font = _warm(sf)
+    return font, [sf.text[idx:idx + 20] for idx in range(0, len(sf.text), 20)]
+
+def _modified(sf):
+    font = _parsed(sf)
+    cmap = font.get(b'cmap')
+    cmap[sf.text[0]] = cmap[sf.text[1]]
+    return font
+
+def _dump(blob):
+    grope.dump(blob, io.BytesIO())
+
+def _cold_start(sf, cache=None):
+    # What a freshly started worker does before it can shape.
+    font = OpenTypeFont.parse(io.BytesIO(sf.data), cache=cache)
+    font.get(b'cmap').lookup_many(sf.text[:1])
+    font.get(b'GSUB').make_subber(sf.features)
+    return font
+
+def _primed_cache(sf):
+    path = tempfile.mkdtemp(prefix='otf-cache-')
+    atexit.register(shutil.rmtree, path, True)
+
+    cache = FontCache(path)
+    _cold_start(sf, cache)
+    return cache
+
+# Each benchmark is a (name, setup, run) triple; `setup` prepares a fresh
+# state outside of the measurement, `run` is the measured operation.
+_benchmarks = [
+    ('parse', lambda sf: None, lambda sf, state: _parsed(sf)),
+    ('get_cmap', _parsed, lambda sf, font: font.get(b'cmap')),
+    ('get_gsub', _parsed, lambda sf, font: font.get(b'GSUB')),
+    ('make_subber', _with_gsub, lambda sf, font: font.get(b'GSUB').make_subber(sf.features)),
+    ('get_glyphs', _warm, lambda sf, font: font.get_glyphs(sf.text, sf.features)),
+    ('get_glyphs_many', _short_texts, lambda sf, state: state[0].get_glyphs_many(state[1], sf.features)),
+    ('inv_glyphs', _shaped, lambda sf, state: state[0].inv_glyphs(state[1])),
+    ('inv_glyphs_many', _glyph_runs, lambda sf, state: state[0].inv_glyphs_many(state[1])),
+    ('save', _warm, lambda sf, font: _dump(font.save())),
+    ('save_modified', _modified, lambda sf, font: _dump(font.save())),
+    ('cold_start', lambda sf: None, lambda sf, state: _cold_start(sf)),
+    ('cold_start_cached', _primed_cache, lambda sf, cache: _cold_start(sf, cache)),
+    ]
+
+def _measure(sf, setup, run, repeat):
+    times = []
+    for _ in range(repeat):
+        state = setup(sf)
+        gc.collect()
+        start = time.perf_counter()
+        run(sf, state)
+        times.append(time.perf_counter() - start)
+
+    state = setup(sf)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run(sf, state)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'best': min(times),
+        'mean': sum(times) / len(times),
+        'peak_bytes': peak,
+        }
+
+def _main():
+    ap = argparse.ArgumentParser(description='Times the font operations on a synthetic font.')
+    synthetic.add_arguments(ap)
+    ap.add_argument('--repeat', type=int, default=5)
+    ap.add_argument('--only', nargs='+', choices=[name for name, setup, run in _benchmarks], help='run only these benchmarks')
+    ap.add_argument('--json', help='write the results to this file')
+    ap.add_argument('--baseline', help='compare with the results in this file')
+    ap.add_argument('--tolerance', type=float, default=0.2, help='slowdown against the baseline that counts as a regression')
+    args = ap.parse_args()
+
+    sf = synthetic.generate_from_args(args)
+
+    results = {}
+    for name, setup, run in _benchmarks:
+        if args.only and name not in args.only:
+            continue
+        results[name] = _measure(sf, setup, run, args.repeat)
+
+    report = {
+        'python': platform.python_version(),
+        'numpy': font_module.numpy is not None,
+        'font_bytes': len(sf.data),
+        'params': sf.params,
+        'results': results,
+        }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)['results']
+
+    regressions = []
+    print('{:<16} {:>10} {:>10} {:>12} {:>10}'.format('benchmark', 'best ms', 'mean ms', 'peak KiB', 'vs base'))
+    for name, setup, run in _benchmarks:
+        if name not in results:
+            continue
+        r = results[name]
+        ratio = ''
+        if baseline and name in baseline:
+            ratio = r['best'] / baseline[name]['best']
+            if ratio > 1 + args.tolerance:
+                regressions.append(name)
+            ratio = '{:.2f}x'.format(ratio)
+        print('{:<16} {:>10.3f} {:>10.3f} {:>12.1f} {:>10}'.format(name, r['best'] * 1000, r['mean'] * 1000, r['peak_bytes'] / 1024, ratio))
+
+    if args.json:
+        with open(args.json, 'w') as fout:
+            json.dump(report, fout, indent=2, sort_keys=True)
+
+    if regressions:
+        print('regressions: {}'.format(', '.join(regressions)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,266 @@
+import sys, struct, math, random, argparse, six
+
+def _words(*words):
+    return struct.pack('>{}H'.format(len(words)), *words)
+
+def _pad4(data):
+    return data + b'\0' * (-len(data) % 4)
+
+def _checksum(data):
+    data = _pad4(data)
+    return sum(struct.unpack('>{}I'.format(len(data) // 4), data)) & 0xffffffff
+
+def make_cmap(mapping):
+    '''
+    Builds a cmap table with a (3,1) format 4 subtable from a codepoint to
+    glyph dict. Runs of consecutive glyphs become delta segments, the rest
+    of each 256-codepoint block goes into the glyph id array.
+    '''
+
+    segments = []
+    for block in sorted(set(cid >> 8 for cid in mapping)):
+        cids = [cid for cid in six.moves.range(block << 8, (block + 1) << 8) if cid in mapping and cid < 0xffff]
+        if not cids:
+            continue
+        first, last = cids[0], cids[-1]
+        if len(cids) == last - first + 1 and all(mapping[cid] - cid == mapping[first] - first for cid in cids):
+            segments.append((first, last, (mapping[first] - first) & 0xffff, None))
+        else:
+            segments.append((first, last, 0, [mapping.get(cid, 0) for cid in six.moves.range(first, last + 1)]))
+    segments.append((0xffff, 0xffff, 1, None))
+
+    seg_count = len(segments)
+    glyph_array = []
+    id_range_offset = []
+    for sid, (start, end, delta, glyphs) in enumerate(segments):
+        if glyphs is None:
+            id_range_offset.append(0)
+        else:
+            id_range_offset.append(2 * (seg_count - sid + len(glyph_array)))
+            glyph_array.extend(glyphs)
+
+    words = [end for start, end, delta, glyphs in segments]
+    words.append(0)
+    words.extend(start for start, end, delta, glyphs in segments)
+    words.extend(delta for start, end, delta, glyphs in segments)
+    words.extend(id_range_offset)
+    words.extend(glyph_array)
+
+    length = 14 + 2 * len(words)
+    if length > 0xffff:
+        raise ValueError('the character map does not fit into a format 4 subtable, lower the glyph count or raise the density')
+
+    entry_selector = int(math.floor(math.log2(seg_count)))
+    search_range = 2 * 2**entry_selector
+    subtable = _words(4, length, 0, 2 * seg_count, search_range, entry_selector, 2 * seg_count - search_range, *words)
+    return _words(0, 1) + struct.pack('>HHI', 3, 1, 12) + subtable
+
+def make_coverage(gids, format):
+    gids = sorted(set(gids))
+    if format == 1:
+        return _words(1, len(gids), *gids)
+
+    ranges = []
+    for covidx, gid in enumerate(gids):
+        if ranges and ranges[-1][1] + 1 == gid:
+            ranges[-1][1] = gid
+        else:
+            ranges.append([gid, gid, covidx])
+    return _words(2, len(ranges), *(word for rng in ranges for word in rng))
+
+def make_single_subst(mapping, format, coverage_format):
+    gids = sorted(mapping)
+    coverage = make_coverage(gids, coverage_format)
+    if format == 1:
+        return struct.pack('>HHh', 1, 6, mapping[gids[0]] - gids[0]) + coverage
+    return _words(2, 6 + 2 * len(gids), len(gids), *(mapping[gid] for gid in gids)) + coverage
+
+def make_ligature_subst(ligatures, coverage_format):
+    # `ligatures` maps the first glyph to a list of (components, ligature glyph).
+    firsts = sorted(ligatures)
+
+    offset = 6 + 2 * len(firsts)
+    ligaset_offsets = []
+    data = b''
+    for first in firsts:
+        ligaset_offsets.append(offset + len(data))
+        ligaset = ligatures[first]
+        liga_offsets = []
+        body = b''
+        for components, target in ligaset:
+            liga_offsets.append(2 + 2 * len(ligaset) + len(body))
+            body += _words(target, len(components) + 1, *components)
+        data += _words(len(ligaset), *liga_offsets) + body
+
+    return _words(1, offset + len(data), len(firsts), *ligaset_offsets) + data + make_coverage(firsts, coverage_format)
+
+def _offset_list(header, items):
+    offset = len(header) + 2 + 2 * len(items)
+    offsets = []
+    data = b''
+    for item in items:
+        offsets.append(offset + len(data))
+        data += item
+    if offsets and offsets[-1] > 0xffff:
+        raise ValueError('the lookups do not fit into a GSUB table, use fewer lookups or glyphs')
+    return header + _words(len(items), *offsets) + data
+
+def make_lookup(lookup_type, subtables):
+    offset = 8 + 2 * len(subtables)
+    offsets = []
+    data = b''
+    for subtable in subtables:
+        offsets.append(offset + len(data))
+        data += subtable
+    return _words(lookup_type, 0, len(subtables), *offsets) + _words(0) + data
+
+def make_gsub(lookups, features):
+    # `features` is a list of (tag, lookup indices), the default language
+    # system of the DFLT script enables all of them.
+    lookup_list = _offset_list(b'', lookups)
+
+    offset = 2 + 6 * len(features)
+    records = b''
+    data = b''
+    for tag, indices in features:
+        records += tag + _words(offset + len(data))
+        data += _words(0, len(indices), *indices)
+    feature_list = _words(len(features)) + records + data
+
+    langsys = _words(0, 0xffff, len(features), *six.moves.range(len(features)))
+    script_list = _words(1) + b'DFLT' + _words(8) + _words(4, 0) + langsys
+
+    script_offset = 10
+    feature_offset = script_offset + len(script_list)
+    lookup_offset = feature_offset + len(feature_list)
+    return _words(1, 0, script_offset, feature_offset, lookup_offset) + script_list + feature_list + lookup_list
+
+def make_head():
+    return struct.pack('>HHIIIHHQQhhhhHHhhh', 1, 0, 0x10000, 0, 0x5f0f3cf5, 0, 1000, 0, 0, 0, 0, 1000, 1000, 0, 8, 2, 0, 0)
+
+def make_font(tables):
+    tables = sorted(tables.items())
+    count = len(tables)
+    entry_selector = int(math.floor(math.log2(count)))
+    header = struct.pack('>IHHHH', 0x10000, count, 2**entry_selector * 16, entry_selector, (count - 2**entry_selector) * 16)
+
+    offset = 12 + 16 * count
+    records = b''
+    data = b''
+    for tag, table in tables:
+        records += struct.pack('>4sIII', tag, _checksum(table), offset + len(data), len(table))
+        data += _pad4(table)
+    return header + records + data
+
+class SyntheticFont:
+    '''
+    A generated font together with what a benchmark needs to drive it:
+    the font bytes, the features its GSUB defines and a sample text that
+    triggers the substitutions.
+    '''
+
+    def __init__(self, data, features, text, params):
+        self.data = data
+        self.features = features
+        self.text = text
+        self.params = params
+
+def generate(glyphs=3000, cmap_density=0.5, lookups=8, ligaset_size=4, coverage_format=2, text_length=10000, seed=0):
+    '''
+    Builds a font with `glyphs` glyphs, a BMP character map in which
+    `cmap_density` of the codepoints from U+0020 up are mapped, and
+    `lookups` GSUB lookups alternating between single and ligature
+    substitutions. Ligature sets hold `ligaset_size` ligatures each.
+    `coverage_format` is 1, 2 or 0 for a mix of both.
+    '''
+
+    rng = random.Random(seed)
+    params = dict(glyphs=glyphs, cmap_density=cmap_density, lookups=lookups, ligaset_size=ligaset_size,
+        coverage_format=coverage_format, text_length=text_length, seed=seed)
+
+    mapping = {}
+    cid = 0x20
+    gid = 1
+    while gid < glyphs:
+        if cid >= 0xfffe:
+            raise ValueError('too many glyphs for the character map density')
+        if cid < 0xd800 or cid > 0xdfff:
+            if rng.random() < cmap_density:
+                mapping[cid] = gid
+                gid += 1
+        cid += 1
+
+    cids = sorted(mapping)
+
+    # Most of the text comes from a small set of frequent characters, the
+    # lookups are built around those so that they fire.
+    common = cids[:64]
+    common_gids = [mapping[cid] for cid in common]
+
+    def coverage_format_for(idx):
+        return coverage_format or 1 + idx % 2
+
+    lookup_tables = []
+    single_indices = []
+    liga_indices = []
+    for idx in six.moves.range(lookups):
+        covered = rng.sample(six.moves.range(1, glyphs), min(glyphs - 1, max(1, glyphs // 10), 512))
+        covered = sorted(set(covered + common_gids[idx % 8::8]))
+        if idx % 2 == 0:
+            if idx % 4 == 0:
+                delta = rng.randrange(1, 16)
+                mapping1 = { gid: (gid + delta) % glyphs for gid in covered }
+                subtable = make_single_subst(mapping1, 1, coverage_format_for(idx))
+            else:
+                mapping1 = { gid: rng.randrange(1, glyphs) for gid in covered }
+                subtable = make_single_subst(mapping1, 2, coverage_format_for(idx))
+            single_indices.append(idx)
+            lookup_tables.append(make_lookup(1, [subtable]))
+        else:
+            ligatures = {}
+            for first in rng.sample(common_gids, min(len(common_gids), 16)) + rng.sample(covered, min(len(covered), 32)):
+                ligatures[first] = [([rng.choice(common_gids) for _ in six.moves.range(rng.randrange(1, 4))], rng.randrange(1, glyphs))
+                    for _ in six.moves.range(ligaset_size)]
+            liga_indices.append(idx)
+            lookup_tables.append(make_lookup(4, [make_ligature_subst(ligatures, coverage_format_for(idx))]))
+
+    features = [(b'ccmp', single_indices), (b'liga', liga_indices)]
+
+    tables = {
+        b'head': make_head(),
+        b'cmap': make_cmap(mapping),
+        b'GSUB': make_gsub(lookup_tables, features),
+        # Stands in for the glyph outlines, it is passed through untouched.
+        b'glyf': bytes(bytearray(rng.getrandbits(8) for _ in six.moves.range(32 * glyphs))),
+        }
+
+    text = ''.join(six.unichr(rng.choice(common) if rng.random() < 0.7 else rng.choice(cids)) for _ in six.moves.range(text_length))
+    return SyntheticFont(make_font(tables), frozenset(tag for tag, indices in features), text, params)
+
+def add_arguments(ap):
+    ap.add_argument('--glyphs', type=int, default=3000)
+    ap.add_argument('--cmap-density', type=float, default=0.5, help='fraction of codepoints that are mapped')
+    ap.add_argument('--lookups', type=int, default=8)
+    ap.add_argument('--ligaset-size', type=int, default=4, help='ligatures per ligature set')
+    ap.add_argument('--coverage-format', type=int, choices=(0, 1, 2), default=2, help='0 mixes both formats')
+    ap.add_argument('--text-length', type=int, default=10000)
+    ap.add_argument('--seed', type=int, default=0)
+
+def generate_from_args(args):
+    return generate(glyphs=args.glyphs, cmap_density=args.cmap_density, lookups=args.lookups, ligaset_size=args.ligaset_size,
+        coverage_format=args.coverage_format, text_length=args.text_length, seed=args.seed)
+
+def _main():
+    ap = argparse.ArgumentParser(description='Writes a synthetic font, e.g. as an input to transform.py.')
+    ap.add_argument('output')
+    add_arguments(ap)
+    args = ap.parse_args()
+
+    font = generate_from_args(args)
+    with open(args.output, 'wb') as fout:
+        fout.write(font.data)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -1,2 +1,3 @@
-from .font import OpenTypeFont
-
+from .font import OpenTypeFont, FontCollection
+from .stats import Stats
+from .cache import FontCache
@@ -1,6 +1,5 @@
-from .struct2 import struct_be, parse, parse_array
-from grope import BlobIO
-import six, grope
+from .struct2 import struct_be, parse_at, read_array
+import six, grope, array, sys, bisect, collections, marshal
 
 @struct_be
 class OTF_tag_hdr:
@@ -15,14 +14,40 @@ class OTF_tag_offset:
     H:offset
     '''
 
-    @classmethod
-    def pair(cls, fin):
-        obj = cls.parse(fin)
-        return obj.tag, obj.offset
+def _array(typecode, data):
+    r = array.array(typecode)
+    r.frombytes(data)
+    return r
+
+class Interner:
+    '''
+    Shares structures that several tables point to. A structure is parsed
+    the first time it is requested by its kind and offset into the table;
+    later requests get the same object.
+    '''
 
-def load_taglist(fin):
-    hdr = OTF_tag_hdr.parse(fin)
-    return [OTF_tag_offset.pair(fin) for i in six.moves.range(hdr.count)]
+    def __init__(self):
+        self._cache = {}
+        self.parsed = collections.Counter()
+        self.reused = collections.Counter()
+
+    def __call__(self, kind, key, parse_fn, *args):
+        try:
+            r = self._cache[kind, key]
+        except KeyError:
+            r = parse_fn(*args)
+            self._cache[kind, key] = r
+            self.parsed[kind] += 1
+        else:
+            self.reused[kind] += 1
+        return r
+
+def _no_intern(kind, key, parse_fn, *args):
+    return parse_fn(*args)
+
+def load_taglist(blob, offs):
+    hdr = OTF_tag_hdr.parse_blob(blob, offs)
+    return [(rec.tag, rec.offset) for rec in OTF_tag_offset.parse_many(blob, offs + OTF_tag_hdr.size, hdr.count)]
 
 @struct_be
 class GSUB_hdr:
@@ -66,45 +91,41 @@ class Script:
         self.langs = langs
 
 class Feature:
-    def __init__(self, tag, params, lookups):
+    def __init__(self, tag, params, lookup_indices):
         self.tag = tag
         self.params = params
-        self.lookups = lookups
+        self.lookup_indices = lookup_indices
 
-def parse_langsys(blob, features):
-    fin = BlobIO(blob)
-    hdr = OTF_langsys.parse(fin)
-    selected_features = [features[OTF_feature_index.parse(fin).index] for i in six.moves.range(hdr.featureIndexCount)]
+def parse_langsys(blob, offs, features):
+    hdr = OTF_langsys.parse_blob(blob, offs)
+    selected_features = [features[rec.index] for rec in OTF_feature_index.parse_many(blob, offs + OTF_langsys.size, hdr.featureIndexCount)]
     return LangSys(hdr.lookupOrder, hdr.requiredFeatureIndex, selected_features)
 
-def parse_script(blob, features):
-    fin = BlobIO(blob)
-    hdr = OTF_script_table.parse(fin)
-    langsys_list = load_taglist(fin)
+def parse_script(blob, offs, features, intern=_no_intern):
+    hdr = OTF_script_table.parse_blob(blob, offs)
+    langsys_list = load_taglist(blob, offs + OTF_script_table.size)
 
     langs = {}
     if hdr.defaultLangSys != 0:
-        langs[None] = parse_langsys(blob[hdr.defaultLangSys:], features)
+        langs[None] = intern('langsys', offs + hdr.defaultLangSys, parse_langsys, blob, offs + hdr.defaultLangSys, features)
 
     for lang, offset in langsys_list:
-        langs[lang] = parse_langsys(blob[offset:], features)
+        langs[lang] = intern('langsys', offs + offset, parse_langsys, blob, offs + offset, features)
     return Script(hdr.defaultLangSys, langs)
 
-def parse_scriptlist(blob, features):
-    scripts = load_taglist(BlobIO(blob))
-    return { tag: parse_script(blob[offset:], features) for tag, offset in scripts }
+def parse_scriptlist(blob, offs, features, intern=_no_intern):
+    scripts = load_taglist(blob, offs)
+    return { tag: parse_script(blob, offs + offset, features, intern) for tag, offset in scripts }
 
-def parse_feature(blob, tag, lookups):
-    fin = BlobIO(blob)
-    feature_params, lookup_index_count = parse(fin, '>HH')
-    lookup_indices = parse_array(fin, '>H', lookup_index_count)
+def parse_feature(blob, offs, tag):
+    feature_params, lookup_index_count = parse_at(blob, offs, '>HH')
+    lookup_indices = read_array(blob, offs + 4, lookup_index_count)
 
-    return Feature(tag, feature_params, [lookup for idx in lookup_indices for lookup in lookups[idx]])
+    return Feature(tag, feature_params, lookup_indices)
 
-def parse_feature_list(blob, lookups):
-    fin = BlobIO(blob)
-    features = load_taglist(fin)
-    return [parse_feature(blob[offs:], tag, lookups) for tag, offs in features]
+def parse_feature_list(blob, offs):
+    features = load_taglist(blob, offs)
+    return [parse_feature(blob, offs + offset, tag) for tag, offset in features]
 
 @struct_be
 class _cov_range_rec:
@@ -114,156 +135,557 @@ class _cov_range_rec:
     H:start_covidx
     '''
 
-def parse_coverage(blob):
-    fin = BlobIO(blob)
-    format, = parse(fin, '>H')
+class Coverage:
+    '''
+    A coverage table compiled into a constant-time lookup: a gid-indexed
+    array for coverages that densely fill their gid span, a dict otherwise.
+    '''
+
+    def __init__(self, ranges):
+        # `ranges` are (start_gid, end_gid, start_covidx) triples, the first
+        # range to mention a glyph determines its coverage index.
+        ranges = [rng for rng in ranges if rng[0] <= rng[1]]
+        count = sum(end - start + 1 for start, end, covidx in ranges)
+        if not ranges:
+            self._base = 0
+            self._table = {}
+            self.get = self._table.get
+            return
+
+        lo = min(start for start, end, covidx in ranges)
+        hi = max(end for start, end, covidx in ranges)
+
+        if hi - lo + 1 <= _dense_coverage_ratio * count:
+            self._base = lo
+            self._table = array.array('H', bytes(2 * (hi - lo + 1)))
+            for start, end, covidx in reversed(ranges):
+                self._table[start - lo:end - lo + 1] = array.array('H', six.moves.range(covidx + 1, covidx + end - start + 2))
+        else:
+            self._base = 0
+            self._table = {}
+            for start, end, covidx in reversed(ranges):
+                self._table.update(zip(six.moves.range(start, end + 1), six.moves.range(covidx, covidx + end - start + 1)))
+            self.get = self._table.get
+
+    @classmethod
+    def _from_table(cls, base, table):
+        self = cls.__new__(cls)
+        self._base = base
+        self._table = table
+        if isinstance(table, dict):
+            self.get = table.get
+        return self
+
+    def get(self, gid):
+        idx = gid - self._base
+        if 0 <= idx < len(self._table):
+            covidx = self._table[idx]
+            if covidx:
+                return covidx - 1
+        return None
+
+    def __call__(self, gids, idx):
+        return self.get(gids[idx])
+
+    def __len__(self):
+        if isinstance(self._table, dict):
+            return len(self._table)
+        return len(self._table) - self._table.count(0)
+
+    def __contains__(self, gid):
+        return self.get(gid) is not None
+
+    def __iter__(self):
+        if isinstance(self._table, dict):
+            return iter(self._table)
+        return (self._base + idx for idx, covidx in enumerate(self._table) if covidx)
+
+    @property
+    def dense(self):
+        return not isinstance(self._table, dict)
+
+    @property
+    def nbytes(self):
+        return sys.getsizeof(self._table)
+
+# Coverages whose gid span is at most this many times the number of glyphs
+# they cover are compiled into gid-indexed arrays.
+_dense_coverage_ratio = 4
+
+def parse_coverage(blob, offs=0):
+    format, = parse_at(blob, offs, '>H')
     if format == 1:
-        glyph_count, = parse(fin, '>H')
-        glyph_array = parse_array(fin, '>H', glyph_count)
-        def cov1(gids, idx):
-            try:
-                return glyph_array.index(gids[idx])
-            except ValueError:
-                return None
-        return cov1
+        glyph_count, = parse_at(blob, offs + 2, '>H')
+        glyph_array = read_array(blob, offs + 4, glyph_count)
+        return Coverage([(gid, gid, covidx) for covidx, gid in enumerate(glyph_array)])
 
     if format == 2:
-        range_count, = parse(fin, '>H')
-        ranges = [_cov_range_rec.parse(fin) for i in six.moves.range(range_count)]
-        def cov2(gids, idx):
-            gid = gids[idx]
-            for range in ranges:
-                if range.start_gid <= gid <= range.end_gid:
-                    return range.start_covidx + gid - range.start_gid
-            return None
-        return cov2
+        range_count, = parse_at(blob, offs + 2, '>H')
+        ranges = _cov_range_rec.parse_many(blob, offs + 4, range_count)
+        return Coverage([(rng.start_gid, rng.end_gid, rng.start_covidx) for rng in ranges])
 
     raise RuntimeError('unknown coverage format')
 
-def parse_gsub_lookup1(blob):
-    fin = BlobIO(blob)
-    format, = parse(fin, '>H')
+# Subtables are closures over their compiled data; `spec` holds that data
+# as a (kind, argument) pair, so that the subtable can be rebuilt by
+# `_subtable_builders[kind](coverage, argument)`. The kinds are the single
+# substitution formats and the ligature lookup type.
+
+def _make_sub1(coverage, delta_glyph_id):
+    def sub1(buf):
+        if coverage.get(buf.cur) is not None:
+            buf.cur += delta_glyph_id
+    sub1.coverage = coverage
+    sub1.spec = 1, delta_glyph_id
+    return sub1
+
+def _make_sub2(coverage, substitute_gids):
+    def sub2(buf):
+        cov_idx = coverage.get(buf.cur)
+        if cov_idx is not None:
+            buf.cur = substitute_gids[cov_idx]
+    sub2.coverage = coverage
+    sub2.spec = 2, substitute_gids
+    return sub2
+
+def parse_gsub_lookup1(blob, offs=0, intern=_no_intern):
+    format, = parse_at(blob, offs, '>H')
     if format == 1:
-        coverage_offs, delta_glyph_id = parse(fin, '>Hh')
-        coverage = parse_coverage(blob[coverage_offs:])
-        def sub1(gids, idx):
-            if coverage(gids, idx) is not None:
-                gids[idx] += delta_glyph_id
-        return sub1
+        coverage_offs, delta_glyph_id = parse_at(blob, offs + 2, '>Hh')
+        coverage = intern('coverage', offs + coverage_offs, parse_coverage, blob, offs + coverage_offs)
+        return _make_sub1(coverage, delta_glyph_id)
     elif format == 2:
-        coverage_offs, glyph_count = parse(fin, '>HH')
-        substitute_gids = parse_array(fin, '>H', glyph_count)
-        coverage = parse_coverage(blob[coverage_offs:])
-        def sub2(gids, idx):
-            cov_idx = coverage(gids, idx)
-            if cov_idx is not None:
-                gids[idx] = substitute_gids[cov_idx]
-        return sub2
+        coverage_offs, glyph_count = parse_at(blob, offs + 2, '>HH')
+        substitute_gids = read_array(blob, offs + 6, glyph_count)
+        coverage = intern('coverage', offs + coverage_offs, parse_coverage, blob, offs + coverage_offs)
+        return _make_sub2(coverage, substitute_gids)
 
     else:
         raise RuntimeError('unknown subtable format')
 
-def parse_liga(blob):
-    fin = BlobIO(blob)
-    target_gid, component_count = parse(fin, '>HH')
-    components = parse_array(fin, '>H', component_count - 1)
+def parse_liga(blob, offs=0):
+    target_gid, component_count = parse_at(blob, offs, '>HH')
+    components = read_array(blob, offs + 4, component_count - 1)
     return components, target_gid
 
-def parse_ligaset(blob):
-    fin = BlobIO(blob)
-    count, = parse(fin, '>H')
-    liga_offsets = parse_array(fin, '>H', count)
-    return [parse_liga(blob[offs:]) for offs in liga_offsets]
+def parse_ligaset(blob, offs=0):
+    count, = parse_at(blob, offs, '>H')
+    liga_offsets = read_array(blob, offs + 2, count)
+    return [parse_liga(blob, offs + liga_offs) for liga_offs in liga_offsets]
 
-def parse_gsub_lookup4(blob):
-    fin = BlobIO(blob)
-    format, cov_offset, ligaset_count = parse(fin, '>HHH')
+def compile_ligaset(ligatures):
+    '''
+    Compiles a ligature set into a trie over the components that follow
+    the first glyph. Each node is a `(children, terminal, desc_min)`
+    triple, `terminal` being the `(index, target_gid)` of the first
+    ligature in the set that ends at the node and `desc_min` the smallest
+    index of a ligature ending below it.
+    '''
+
+    root = [{}, None]
+    for index, (components, target) in enumerate(ligatures):
+        node = root
+        for gid in components:
+            node = node[0].setdefault(gid, [{}, None])
+        if node[1] is None:
+            node[1] = index, target
+
+    def freeze(node):
+        children = { gid: freeze(child) for gid, child in six.iteritems(node[0]) }
+        desc_min = min([child[1][0] for child in six.itervalues(children) if child[1] is not None]
+            + [child[2] for child in six.itervalues(children)] + [len(ligatures)])
+        return children, node[1], desc_min
+
+    return freeze(root)
+
+def _compile_ligaset_at(blob, offs):
+    return compile_ligaset(parse_ligaset(blob, offs))
+
+def parse_gsub_lookup4(blob, offs=0, intern=_no_intern):
+    format, cov_offset, ligaset_count = parse_at(blob, offs, '>HHH')
     if format != 1:
         raise RuntimeError('unknown ligature format')
-    coverage = parse_coverage(blob[cov_offset:])
-    ligasets = [parse_ligaset(blob[offs:]) for offs in parse_array(fin, '>H', ligaset_count)]
-
-    def sub_liga(gids, idx):
-        cov_idx = coverage(gids, idx)
+    coverage = intern('coverage', offs + cov_offset, parse_coverage, blob, offs + cov_offset)
+    ligasets = [intern('ligaset', offs + ligaset_offs, _compile_ligaset_at, blob, offs + ligaset_offs)
+        for ligaset_offs in read_array(blob, offs + 6, ligaset_count)]
+    return _make_sub_liga(coverage, ligasets)
+
+def _make_sub_liga(coverage, ligasets):
+    def sub_liga(buf):
+        cov_idx = coverage.get(buf.cur)
         if cov_idx is None:
             return
-        for components, target in ligasets[cov_idx]:
-            if gids[idx+1:idx+1+len(components)] == components:
-                gids[idx:idx+1+len(components)] = [target]
+
+        # Walk the trie along the following glyphs, the ligature that comes
+        # first in the set wins, regardless of its length.
+        gids = buf.input
+        node = ligasets[cov_idx]
+        best = None
+        pos = buf.pos + 1
+        while True:
+            children, terminal, desc_min = node
+            if terminal is not None and (best is None or terminal[0] < best[0]):
+                best = terminal
+                end = pos
+
+            if pos == len(gids) or (best is not None and desc_min > best[0]):
+                break
+
+            node = children.get(gids[pos])
+            if node is None:
                 break
+            pos += 1
+
+        if best is not None:
+            buf.pos = end - 1
+            buf.cur = best[1]
 
+    sub_liga.coverage = coverage
+    sub_liga.spec = 4, ligasets
     return sub_liga
 
+_subtable_builders = {
+    1: _make_sub1,
+    2: _make_sub2,
+    4: _make_sub_liga,
+    }
+
 _gsub_lookups = {
     1: parse_gsub_lookup1,
     4: parse_gsub_lookup4,
     }
 
-def parse_lookup(blob):
-    fin = BlobIO(blob)
-    lookup_type, lookup_flag, subtable_count = parse(fin, '>HHH')
-    subtable_offsets = parse_array(fin, '>H', subtable_count)
-    mark_filtering_set = parse(fin, '>H')
+def parse_lookup(blob, offs=0, intern=_no_intern):
+    lookup_type, lookup_flag, subtable_count = parse_at(blob, offs, '>HHH')
+    subtable_offsets = read_array(blob, offs + 6, subtable_count)
 
     assert lookup_type in (1, 3, 4, 6)
 
     parse_fn = _gsub_lookups.get(lookup_type)
     if parse_fn:
-        subbers = [parse_fn(blob[offs:]) for offs in subtable_offsets]
+        subbers = [intern('subtable', (lookup_type, offs + subtable_offs), parse_fn, blob, offs + subtable_offs, intern)
+            for subtable_offs in subtable_offsets]
     else:
         subbers = []
 
     return subbers
 
-def parse_lookup_list(blob):
-    fin = BlobIO(blob)
-    count, = parse(fin, '>H')
-    lookup_offsets = parse_array(fin, '>H', count)
+def parse_lookup_offsets(blob, offs=0):
+    count, = parse_at(blob, offs, '>H')
+    return read_array(blob, offs + 2, count)
 
-    lookups = []
-    for offs in lookup_offsets:
-        lookups.append(parse_lookup(blob[offs:]))
+class GlyphBuffer:
+    '''
+    Holds the state of a single forward shaping pass. Subtables inspect and
+    replace the current glyph `cur`, read the input glyphs that follow it
+    and, for ligatures, consume them by advancing `pos`. The output glyphs
+    are appended to `gids` together with the index of the first input
+    glyph each of them was formed from.
+    '''
 
-    return lookups
+    def __init__(self, gids):
+        self.input = gids if isinstance(gids, (list, tuple, array.array)) else list(gids)
+        self.pos = 0
+        self.cur = None
+        self.gids = []
+        self.clusters = []
 
 class _Subber:
-    def __init__(self, lookups):
+    def __init__(self, lookups, stats=None):
         self._lookups = lookups
+        self._stats = stats
+
+        # Maps each glyph to the positions of the subtables that can fire
+        # on it, in lookup order.
+        dispatch = {}
+        for order, lookup in enumerate(lookups):
+            for gid in lookup.coverage:
+                dispatch.setdefault(gid, []).append(order)
+        self._dispatch = { gid: tuple(orders) for gid, orders in six.iteritems(dispatch) }
 
     def sub(self, gids):
-        gids = list(gids)
-
-        i = 0
-        while i < len(gids):
-            for lookup in self._lookups:
-                new_i = lookup(gids, i)
-                if new_i is not None:
-                    i = new_i
-                    break
-            else:
-                i += 1
-        
-        return gids
+        return self.shape(gids).gids
+
+    def shape(self, gids):
+        if self._stats is not None:
+            return self._stats._shape(self._shape, gids)
+        return self._shape(gids)
+
+    def _shape(self, gids):
+        buf = GlyphBuffer(gids)
+
+        lookups = self._lookups
+        dispatch = self._dispatch
+        input = buf.input
+        out_gids = buf.gids
+        out_clusters = buf.clusters
+
+        pos = 0
+        while pos < len(input):
+            gid = input[pos]
+            candidates = dispatch.get(gid)
+            if candidates is None:
+                out_gids.append(gid)
+                out_clusters.append(pos)
+                pos += 1
+                continue
+
+            cluster = pos
+            buf.pos, buf.cur = pos, gid
+            k = 0
+            while k < len(candidates):
+                order = candidates[k]
+                gid, pos = buf.cur, buf.pos
+                lookups[order](buf)
+
+                if buf.cur != gid or buf.pos != pos:
+                    # The glyph was replaced, continue with the subtables
+                    # covering the new one that come after this lookup.
+                    candidates = dispatch.get(buf.cur, ())
+                    k = bisect.bisect_right(candidates, order)
+                else:
+                    k += 1
+
+            out_gids.append(buf.cur)
+            out_clusters.append(cluster)
+            pos = buf.pos + 1
+
+        buf.pos = pos
+        return buf
+
+_SubberCacheInfo = collections.namedtuple('_SubberCacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
 
 class OtfGsubTable:
-    def __init__(self, name, blob):
+    # Nothing modifies a parsed GSUB table, it is always saved as it was read.
+    dirty = False
+
+    # Subbers compiled while this is set count and time their subtables.
+    stats = None
+
+    def __init__(self, name, blob, eager=False):
+        # Lookups are parsed from the blob long after the table is, when the
+        # file a rope reads from may be closed; such blobs are copied once.
+        if not isinstance(blob, (bytes, bytearray, memoryview)):
+            blob = bytes(blob)
+
         hdr = GSUB_hdr.parse_blob(blob)
 
         if (hdr.majorVersion, hdr.minorVersion) != (1, 0):
             raise RuntimeError('unknown GSUB table version')
 
-        lookups = parse_lookup_list(blob[hdr.lookupListOffset:])
-        features = parse_feature_list(blob[hdr.featureListOffset:], lookups)
-        scripts = parse_scriptlist(blob[hdr.scriptListOffset:], features)
+        self._intern = Interner()
+
+        features = parse_feature_list(blob, hdr.featureListOffset)
+        scripts = parse_scriptlist(blob, hdr.scriptListOffset, features, self._intern)
+        self._setup(name, blob, features, scripts)
+
+        # Lookups are parsed the first time a subber needs them.
+        self._lookup_list_offset = hdr.lookupListOffset
+        self._lookup_offsets = parse_lookup_offsets(blob, hdr.lookupListOffset)
+        self._lookups = [None] * len(self._lookup_offsets)
 
+        if eager:
+            self.warm_up()
+
+    def _setup(self, name, blob, features, scripts):
         self.name = name
+        self._blob = blob
+        self._features = features
         self._scripts = scripts
 
+        self._subbers = collections.OrderedDict()
+        self._subber_hits = 0
+        self._subber_misses = 0
+
+    def _cache_sections(self):
+        '''
+        Returns the compiled table as the sections of a `FontCache` entry:
+        all lookups are parsed and stored along with the features and
+        scripts, shared structures stored once. Lookups that fail to parse
+        are stored unparsed, they fail again if a subber ever needs them.
+        '''
+
+        for idx in six.moves.range(len(self._lookups)):
+            try:
+                self._lookup(idx)
+            except Exception:
+                pass
+
+        feature_indices = { id(feature): idx for idx, feature in enumerate(self._features) }
+        indices = {}
+        langsys_list = []
+        coverages = []
+        ligasets = []
+        subtables = []
+        lookups = []
+
+        def index(items, obj, export):
+            idx = indices.get(id(obj))
+            if idx is None:
+                idx = indices[id(obj)] = len(items)
+                items.append(export(obj))
+            return idx
+
+        def export_langsys(langsys):
+            return langsys.lookup_order, langsys.req_feature, [feature_indices[id(feature)] for feature in langsys.features]
+
+        def export_coverage(coverage):
+            table = coverage._table
+            return coverage._base, table if isinstance(table, dict) else table.tobytes()
+
+        def export_subtable(subtable):
+            kind, arg = subtable.spec
+            if kind == 2:
+                arg = arg.tobytes()
+            elif kind == 4:
+                arg = [index(ligasets, ligaset, lambda ligaset: ligaset) for ligaset in arg]
+            return kind, index(coverages, subtable.coverage, export_coverage), arg
+
+        def export_lookup(lookup):
+            return [index(subtables, subtable, export_subtable) for subtable in lookup]
+
+        model = (
+            [(feature.tag, feature.params, feature.lookup_indices.tobytes()) for feature in self._features],
+            { tag: (script.default, { lang: index(langsys_list, langsys, export_langsys) for lang, langsys in six.iteritems(script.langs) })
+                for tag, script in six.iteritems(self._scripts) },
+            langsys_list,
+            self._lookup_list_offset,
+            self._lookup_offsets.tobytes(),
+            [index(lookups, lookup, export_lookup) if lookup is not None else None for lookup in self._lookups],
+            lookups,
+            subtables,
+            coverages,
+            ligasets,
+            )
+        return [(b'model', marshal.dumps(model))]
+
+    @classmethod
+    def _from_cache(cls, name, blob, entry):
+        (features, scripts, langsys_list, lookup_list_offset, lookup_offsets, lookup_ids,
+            lookups, subtables, coverages, ligasets) = marshal.loads(entry.buffer(b'model'))
+
+        features = [Feature(tag, params, _array('H', indices)) for tag, params, indices in features]
+        langsys_list = [LangSys(lookup_order, req_feature, [features[idx] for idx in selected])
+            for lookup_order, req_feature, selected in langsys_list]
+        scripts = { tag: Script(default, { lang: langsys_list[idx] for lang, idx in six.iteritems(langs) })
+            for tag, (default, langs) in six.iteritems(scripts) }
+
+        coverages = [Coverage._from_table(base, table if isinstance(table, dict) else _array('H', table)) for base, table in coverages]
+
+        def restore_subtable(kind, coverage_idx, arg):
+            if kind == 2:
+                arg = _array('H', arg)
+            elif kind == 4:
+                arg = [ligasets[idx] for idx in arg]
+            return _subtable_builders[kind](coverages[coverage_idx], arg)
+
+        subtables = [restore_subtable(*subtable) for subtable in subtables]
+        lookups = [[subtables[idx] for idx in lookup] for lookup in lookups]
+
+        self = cls.__new__(cls)
+        self._setup(name, blob, features, scripts)
+        self._intern = Interner()
+        self._lookup_list_offset = lookup_list_offset
+        self._lookup_offsets = _array('H', lookup_offsets)
+        self._lookups = [lookups[idx] if idx is not None else None for idx in lookup_ids]
+        return self
+
+    def _lookup(self, idx):
+        lookup = self._lookups[idx]
+        if lookup is None:
+            offs = self._lookup_list_offset + self._lookup_offsets[idx]
+            lookup = self._intern('lookup', offs, parse_lookup, self._blob, offs, self._intern)
+            self._lookups[idx] = lookup
+        return lookup
+
+    def warm_up(self):
+        '''
+        Parses all lookups right away, rather than when a subber first
+        needs them.
+        '''
+
+        for idx in six.moves.range(len(self._lookups)):
+            self._lookup(idx)
+
+    def parsed_lookup_count(self):
+        return sum(1 for lookup in self._lookups if lookup is not None)
+
+    def intern_stats(self):
+        '''
+        Returns the number of distinct structures parsed and the number of
+        repeated references that reused them, by kind.
+        '''
+
+        return {
+            'parsed': dict(self._intern.parsed),
+            'reused': dict(self._intern.reused),
+            }
+
+    def coverage_stats(self):
+        coverages = {}
+        for lookup in self._lookups:
+            for subtable in lookup or ():
+                coverages[id(subtable.coverage)] = subtable.coverage
+
+        dense = [cov for cov in coverages.values() if cov.dense]
+        return {
+            'count': len(coverages),
+            'dense': len(dense),
+            'sparse': len(coverages) - len(dense),
+            'glyphs': sum(len(cov) for cov in coverages.values()),
+            'nbytes': sum(cov.nbytes for cov in coverages.values()),
+            }
+
+    # The number of compiled subbers kept by `make_subber`.
+    subber_cache_size = 32
+
     def make_subber(self, enabled_features, script=b'DFLT', langsys=None):
+        '''
+        Compiles a subber for the features enabled in the given script and
+        language system. `enabled_features` is either a predicate called
+        with each feature tag, or a collection of enabled tags; subbers
+        for the latter are cached.
+        '''
+
+        if callable(enabled_features):
+            return self._compile_subber(enabled_features, script, langsys)
+
+        key = frozenset(tag.encode('ascii') if isinstance(tag, six.text_type) else tag for tag in enabled_features), script, langsys
+        subber = self._subbers.get(key)
+        if subber is not None:
+            self._subber_hits += 1
+            self._subbers[key] = self._subbers.pop(key)
+            return subber
+
+        self._subber_misses += 1
+        subber = self._compile_subber(key[0].__contains__, script, langsys)
+        self._subbers[key] = subber
+        while len(self._subbers) > self.subber_cache_size:
+            self._subbers.popitem(last=False)
+        return subber
+
+    def subber_cache_info(self):
+        return _SubberCacheInfo(self._subber_hits, self._subber_misses, self.subber_cache_size, len(self._subbers))
+
+    def set_stats(self, stats):
+        if stats is not self.stats:
+            self.stats = stats
+            self.clear_subber_cache()
+
+    def clear_subber_cache(self):
+        self._subbers.clear()
+        self._subber_hits = 0
+        self._subber_misses = 0
+
+    def _compile_subber(self, enabled_features, script, langsys):
         lookups = []
         for feature in self._scripts[script].langs[langsys].features:
             if not enabled_features(feature.tag):
                 continue
-            lookups.extend(feature.lookups)
+            for idx in feature.lookup_indices:
+                subtables = self._lookup(idx)
+                if self.stats is not None:
+                    subtables = [self.stats._wrap_subtable(idx, subtable_idx, subtable) for subtable_idx, subtable in enumerate(subtables)]
+                lookups.extend(subtables)
 
-        return _Subber(lookups)
+        return _Subber(lookups, self.stats)
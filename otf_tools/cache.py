@@ -0,0 +1,331 @@
+import os, sys, array, hashlib, marshal, time, zlib
+import mmap as _mmap
+from .struct2 import struct_be
+
+@struct_be
+class _cache_entry_header:
+    '''
+    4s:magic
+    H:formatVersion
+    H:sectionCount
+    16s:libraryTag
+    16s:key
+    4s:tableTag
+    I:length
+    I:checksum
+    '''
+
+@struct_be
+class _cache_section_record:
+    '''
+    8s:name
+    I:offset
+    I:length
+    '''
+
+_magic = b'OTFC'
+
+# Bump this whenever the layout of the entries changes.
+_format_version = 1
+
+# Sections start at multiples of this, so that they can be used in place.
+_section_alignment = 8
+
+# Left behind by writers that died, removed once they are this many seconds old.
+_stale_tmp_age = 3600
+
+_entry_ext = '.otfc'
+
+def _library_modules():
+    from . import struct2, cmap, adv_typo
+    return [struct2, cmap, adv_typo, sys.modules[__name__]]
+
+_library_tag_value = None
+
+def _library_tag():
+    '''
+    Identifies the code that wrote an entry: the entry format, the Python
+    and platform details the sections depend on, and the source of the
+    modules that produce and read the cached data. Entries are only read
+    back by exactly the same code.
+    '''
+
+    global _library_tag_value
+    if _library_tag_value is None:
+        h = hashlib.blake2b(digest_size=16)
+        h.update('{} {} {} {} {}'.format(_format_version, sys.implementation.cache_tag, marshal.version,
+            sys.byteorder, array.array('I').itemsize).encode('ascii'))
+        for module in _library_modules():
+            with open(module.__file__, 'rb') as fin:
+                h.update(fin.read())
+        _library_tag_value = h.digest()
+    return _library_tag_value
+
+def _hash_table(tag, blob):
+    h = hashlib.sha256(tag)
+    try:
+        h.update(memoryview(blob))
+    except TypeError:
+        h.update(bytes(blob))
+    return h.digest()[:16]
+
+def _align(v):
+    return -(-v // _section_alignment) * _section_alignment
+
+class CacheEntry:
+    '''
+    The sections of a cache entry, read from a memory-mapped file. Tables
+    restore themselves from these in their `_from_cache`.
+    '''
+
+    def __init__(self, sections):
+        self._sections = sections
+
+    def buffer(self, name):
+        return self._sections[name]
+
+    def array(self, name, typecode):
+        r = array.array(typecode)
+        r.frombytes(self._sections[name])
+        return r
+
+class FontCache:
+    '''
+    Keeps decoded tables in the directory `path`, so that processes opening
+    the same fonts don't have to parse them again. Pass it as `cache` to
+    `OpenTypeFont.open` or `OpenTypeFont.parse`. Tables are keyed by a hash
+    of their bytes, so the cache can be shared by any number of fonts and
+    processes.
+
+    Each entry is a file with a header and the table's sections in native
+    byte order, mapped into memory when it is loaded. Entries are written
+    under a directory named after a tag of the library code, entries of
+    other versions are never read and are the first to go when the cache
+    grows past `max_bytes`; after them, the least recently used entries
+    are removed.
+
+    Only tables that support caching are stored: `cmap` with its decoded
+    and inverse maps and `GSUB` with all of its lookups compiled. Storing
+    a GSUB table parses all of its lookups up front.
+    '''
+
+    def __init__(self, path, max_bytes=512*1024*1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._dir = os.path.join(path, _library_tag().hex())
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+        # The size of all the entries as last seen by this process, the
+        # directory is rescanned once this grows past `max_bytes`.
+        self._size = None
+
+    def _entry_path(self, key):
+        return os.path.join(self._dir, key.hex() + _entry_ext)
+
+    def load_table(self, tag, blob, parser):
+        '''
+        Returns the table `tag` of `blob` as `parser(tag, blob)` would, from
+        the cache if it is there. Otherwise, the table is parsed and stored.
+        '''
+
+        if not hasattr(parser, '_from_cache'):
+            return parser(tag, blob)
+
+        key = _hash_table(tag, blob)
+        table = self._load(key, tag, blob, parser)
+        if table is not None:
+            self.hits += 1
+            return table
+
+        self.misses += 1
+        table = parser(tag, blob)
+        try:
+            sections = table._cache_sections()
+        except Exception:
+            # E.g. a GSUB lookup that can't be parsed; without the cache, it
+            # only fails if a subber needs it, so the table isn't cached.
+            return table
+        self._store(key, tag, sections)
+        return table
+
+    def _load(self, key, tag, blob, parser):
+        path = self._entry_path(key)
+        try:
+            fin = open(path, 'rb')
+        except IOError:
+            return None
+
+        with fin:
+            try:
+                mapping = _mmap.mmap(fin.fileno(), 0, access=_mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                # Empty files can't be mapped.
+                mapping = None
+
+            table = None
+            if mapping is not None:
+                try:
+                    view = memoryview(mapping)
+                    try:
+                        entry = self._read_entry(view, key, tag)
+                        if entry is not None:
+                            table = parser._from_cache(tag, blob, entry)
+                    except Exception:
+                        # A damaged entry is treated as missing and replaced.
+                        table = None
+                    finally:
+                        entry = None
+                        view.release()
+                finally:
+                    mapping.close()
+
+        if table is None:
+            self._remove(path)
+            return None
+
+        # The modification time orders the entries for eviction.
+        try:
+            os.utime(path)
+        except EnvironmentError:
+            pass
+        return table
+
+    def _read_entry(self, view, key, tag):
+        if len(view) < _cache_entry_header.size:
+            return None
+
+        hdr = _cache_entry_header.parse_blob(view)
+        if (hdr.magic != _magic or hdr.formatVersion != _format_version or hdr.libraryTag != _library_tag()
+                or hdr.key != key or hdr.tableTag != tag or hdr.length != len(view)
+                or hdr.checksum != zlib.crc32(view[_cache_entry_header.size:])):
+            return None
+
+        sections = {}
+        for rec in _cache_section_record.parse_many(view, _cache_entry_header.size, hdr.sectionCount):
+            if rec.offset + rec.length > len(view):
+                return None
+            sections[rec.name.rstrip(b'\0')] = view[rec.offset:rec.offset + rec.length]
+        return CacheEntry(sections)
+
+    def _store(self, key, tag, sections):
+        records = []
+        offset = _align(_cache_entry_header.size + _cache_section_record.size * len(sections))
+        for name, data in sections:
+            data = memoryview(data).cast('B')
+            records.append((name, offset, data))
+            offset = _align(offset + len(data))
+
+        length = offset
+        if length > self.max_bytes:
+            return
+
+        data = bytearray(length)
+        pos = _cache_entry_header.size
+        for name, offset, section in records:
+            data[pos:pos + _cache_section_record.size] = _cache_section_record(name=name, offset=offset, length=len(section)).pack()
+            pos += _cache_section_record.size
+            data[offset:offset + len(section)] = section
+
+        hdr = _cache_entry_header(magic=_magic, formatVersion=_format_version, sectionCount=len(sections),
+            libraryTag=_library_tag(), key=key, tableTag=tag, length=length,
+            checksum=zlib.crc32(memoryview(data)[_cache_entry_header.size:]))
+        data[:_cache_entry_header.size] = hdr.pack()
+
+        path = self._entry_path(key)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            if not os.path.isdir(self._dir):
+                os.makedirs(self._dir, exist_ok=True)
+
+            with open(tmp, 'wb') as fout:
+                fout.write(data)
+
+            # Readers see either the complete entry or none at all.
+            os.replace(tmp, path)
+        except EnvironmentError:
+            # The cache is an optimization, a full or read-only disk
+            # doesn't fail the font.
+            self._remove(tmp)
+            return
+
+        self.stores += 1
+        if self._size is not None:
+            self._size += length
+        if self._size is None or self._size > self.max_bytes:
+            self.evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except EnvironmentError:
+            pass
+
+    def _scan(self):
+        # Yields (current, mtime, size, path) for each file in the cache.
+        try:
+            dirs = [entry for entry in os.scandir(self.path) if entry.is_dir()]
+        except EnvironmentError:
+            return
+
+        for dir in dirs:
+            current = dir.path == self._dir
+            try:
+                files = list(os.scandir(dir.path))
+            except EnvironmentError:
+                continue
+            for entry in files:
+                try:
+                    st = entry.stat()
+                except EnvironmentError:
+                    continue
+                yield current, st.st_mtime, st.st_size, entry.path
+
+    def evict(self):
+        '''
+        Removes entries until the cache fits into `max_bytes`: first those
+        written by other versions of the library, then the least recently
+        used ones. Entries are removed down to 3/4 of the limit, so that
+        this isn't needed again right away.
+        '''
+
+        now = time.time()
+        entries = []
+        for current, mtime, size, path in self._scan():
+            if path.endswith('.tmp'):
+                if now - mtime > _stale_tmp_age:
+                    self._remove(path)
+                continue
+            entries.append((current, mtime, size, path))
+
+        size = sum(entry[2] for entry in entries)
+        if size > self.max_bytes:
+            entries.sort()
+            for current, mtime, entry_size, path in entries:
+                if size <= self.max_bytes * 3 // 4:
+                    break
+                self._remove(path)
+                size -= entry_size
+
+            for dir in os.listdir(self.path):
+                if os.path.join(self.path, dir) != self._dir:
+                    try:
+                        os.rmdir(os.path.join(self.path, dir))
+                    except EnvironmentError:
+                        pass
+
+        self._size = size
+
+    def size(self):
+        '''
+        Returns the number of bytes the entries take up on disk.
+        '''
+
+        return sum(size for current, mtime, size, path in self._scan() if not path.endswith('.tmp'))
+
+    def clear(self):
+        for current, mtime, size, path in list(self._scan()):
+            self._remove(path)
+        self._size = 0
@@ -1,6 +1,11 @@
-from .struct2 import struct_be
-from grope import rope, BlobIO
-import six, struct, math
+from .struct2 import struct_be, parse_at, read_array
+from grope import rope
+import six, struct, math, array, sys, bisect, itertools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 @struct_be
 class _cmap_header:
@@ -29,24 +34,173 @@ class _cmap_fmt4_header:
     H:rangeShift
     '''
 
-def _load_array(fin, num, fmt):
-    size = struct.calcsize(fmt)
-    fmt = '>{{}}{}'.format(fmt)
+@struct_be
+class _cmap_fmt12_header:
+    '''
+    H:format
+    H:reserved
+    I:length
+    I:language
+    I:numGroups
+    '''
+
+_numpy_threshold = 128
+
+def _codepoints(cids):
+    if isinstance(cids, six.text_type):
+        cids = [ord(ch) for ch in cids]
+    if numpy is not None and len(cids) >= _numpy_threshold:
+        return numpy.asarray(cids, dtype=numpy.int64)
+    return cids
+
+# Marks the glyphs without a codepoint in inverse maps.
+_no_codepoint = 0xffffffff
+
+def _inverse(gids, cids):
+    '''
+    Returns a gid-indexed array('I') of the highest of the codepoints `cids`
+    mapped to each glyph by the parallel `gids`.
+    '''
+
+    inv = array.array('I', [_no_codepoint]) * 0x10000
+    if numpy is not None:
+        gids = numpy.asarray(gids, dtype=numpy.int64)
+        cids = numpy.asarray(cids, dtype=numpy.int64)
+        if len(cids) and not (cids[:-1] <= cids[1:]).all():
+            order = numpy.argsort(cids, kind='stable')
+            gids, cids = gids[order], cids[order]
+
+        # The last, i.e. the highest, codepoint of each glyph.
+        unique, last = numpy.unique(gids[::-1], return_index=True)
+        highest = cids[::-1][last]
+        mapped = unique != 0
+        numpy.frombuffer(inv, dtype=numpy.uint32)[unique[mapped]] = highest[mapped]
+    else:
+        for gid, cid in zip(gids, cids):
+            if gid and (inv[gid] == _no_codepoint or inv[gid] < cid):
+                inv[gid] = cid
+    return inv
+
+def _empty_map():
+    # The decoded BMP part of a character map, glyph ids indexed by codepoint.
+    return array.array('H', bytes(0x20000))
+
+# Consecutive glyph ids are sliced out of this rather than built one by one.
+_identity = array.array('H', six.moves.range(0x10000))
+
+def _decode_segment(glyphs, delta):
+    if delta == 0:
+        return glyphs
+
+    if numpy is not None and len(glyphs) >= _numpy_threshold:
+        glyphs = numpy.frombuffer(glyphs, dtype=numpy.uint16)
+        r = array.array('H')
+        r.frombytes(numpy.where(glyphs != 0, glyphs + numpy.uint16(delta), glyphs).tobytes())
+        return r
+
+    return array.array('H', [(glyph + delta) & 0xffff if glyph != 0 else 0 for glyph in glyphs])
+
+class _Format4Segments:
+    def __init__(self, end_count, start_count, id_delta, id_range_offset, glyph_ids):
+        self.end_count = end_count
+        self.start_count = start_count
+        self.id_delta = id_delta
+        self.id_range_offset = id_range_offset
+        self.glyph_ids = glyph_ids
+
+    def is_sorted(self):
+        end_count = self.end_count
+        start_count = self.start_count
+        return all(end_count[i] < start_count[i + 1] for i in six.moves.range(len(end_count) - 1))
+
+    def lookup(self, cid):
+        sid = bisect.bisect_left(self.end_count, cid)
+        if sid == len(self.end_count) or self.start_count[sid] > cid:
+            return 0
+
+        if self.id_range_offset[sid] == 0:
+            return (cid + self.id_delta[sid]) & 0xffff
+
+        glyph = self.glyph_ids[cid - self.start_count[sid] - len(self.end_count) + sid + self.id_range_offset[sid] // 2]
+        if glyph != 0:
+            glyph += self.id_delta[sid]
+        return glyph & 0xffff
+
+    def lookup_many(self, cids):
+        # `lookup` of each of the BMP codepoints in the int64 array `cids`,
+        # all of them at once.
+        seg_count = len(self.end_count)
+        gids = numpy.zeros(len(cids), dtype=numpy.int64)
+        if not seg_count:
+            return gids
+
+        end_count = numpy.frombuffer(self.end_count, dtype=numpy.uint16)
+        sid = numpy.minimum(numpy.searchsorted(end_count, cids), seg_count - 1)
+        start = numpy.frombuffer(self.start_count, dtype=numpy.uint16)[sid].astype(numpy.int64)
+        delta = numpy.frombuffer(self.id_delta, dtype=numpy.uint16)[sid].astype(numpy.int64)
+        range_offset = numpy.frombuffer(self.id_range_offset, dtype=numpy.uint16)[sid].astype(numpy.int64)
+        mapped = (start <= cids) & (cids <= end_count[sid])
+
+        direct = mapped & (range_offset == 0)
+        gids[direct] = (cids[direct] + delta[direct]) & 0xffff
+
+        indirect = numpy.flatnonzero(mapped & (range_offset != 0))
+        idx = cids[indirect] - start[indirect] - seg_count + sid[indirect] + range_offset[indirect] // 2
+        inside = (idx >= 0) & (idx < len(self.glyph_ids))
+        glyph_ids = numpy.frombuffer(self.glyph_ids, dtype=numpy.uint16)
+        glyphs = glyph_ids[idx[inside]].astype(numpy.int64)
+        gids[indirect[inside]] = numpy.where(glyphs != 0, (glyphs + delta[indirect[inside]]) & 0xffff, 0)
+
+        # Indices outside of the glyph id array behave as `lookup` does.
+        for pos in indirect[~inside].tolist():
+            gids[pos] = self.lookup(int(cids[pos]))
+        return gids
+
+    def dense(self):
+        end_count = self.end_count
+        start_count = self.start_count
+        id_delta = self.id_delta
+        id_range_offset = self.id_range_offset
+        glyph_ids = self.glyph_ids
+        seg_count = len(end_count)
+
+        cmap = _empty_map()
+
+        for sid in six.moves.range(seg_count):
+            start = start_count[sid]
+            stop = end_count[sid] + 1
+            if start >= stop:
+                continue
+
+            delta = id_delta[sid]
+            if id_range_offset[sid] == 0:
+                first = (start + delta) & 0xffff
+                wrap = min(stop, start + 0x10000 - first)
+                cmap[start:wrap] = _identity[first:first + wrap - start]
+                if wrap < stop:
+                    cmap[wrap:stop] = _identity[:stop - wrap]
+                continue
+
+            adj = start + seg_count - sid - id_range_offset[sid] // 2
+            if start - adj < 0 or stop - adj > len(glyph_ids):
+                # The segment reaches outside of the glyph id array,
+                # decode it glyph by glyph to get the same wraparound and errors.
+                for cid in six.moves.range(start, stop):
+                    glyph = glyph_ids[cid - adj]
+                    if glyph != 0:
+                        glyph += delta
+                    cmap[cid] = glyph % 0x10000
+                continue
+
+            cmap[start:stop] = _decode_segment(glyph_ids[start - adj:stop - adj], delta)
 
-    r = []
-    while num:
-        chunk = min(num, 8*1024)
-        b = fin.read(chunk*size)
-        r.extend(struct.unpack(fmt.format(chunk), b))
-        num -= chunk
-    return r
+        return cmap
 
 def _parse_format4(blob, offs):
-    length, = struct.unpack('>H', bytes(blob[offs+2:offs+4]))
+    length, = parse_at(blob, offs + 2, '>H')
 
     blob = blob[offs:offs+length]
-    fin = BlobIO(blob)
-    hdr = _cmap_fmt4_header.parse(fin)
+    hdr = _cmap_fmt4_header.parse_blob(blob)
     seg_count = hdr.segCountX2 // 2
 
     glyph_id_count = length - (hdr.size + seg_count * 8 + 2)
@@ -55,113 +209,750 @@ def _parse_format4(blob, offs):
 
     glyph_id_count //= 2
 
-    end_count = _load_array(fin, seg_count, 'H')
-    fin.seek(2, 1)
-    start_count = _load_array(fin, seg_count, 'H')
-    id_delta = _load_array(fin, seg_count, 'H')
-    id_range_offset = _load_array(fin, seg_count, 'H')
+    offs = hdr.size
+    end_count = read_array(blob, offs, seg_count)
+    offs += hdr.segCountX2 + 2
+    start_count = read_array(blob, offs, seg_count)
+    offs += hdr.segCountX2
+    id_delta = read_array(blob, offs, seg_count)
+    offs += hdr.segCountX2
+    id_range_offset = read_array(blob, offs, seg_count)
+    offs += hdr.segCountX2
+    glyph_ids = read_array(blob, offs, glyph_id_count)
 
-    glyph_ids = _load_array(fin, glyph_id_count, 'H')
+    return _Format4Segments(end_count, start_count, id_delta, id_range_offset, glyph_ids)
 
-    cmap = [0] * 0x10000
+class _CmapRuns:
+    '''
+    Character runs sorted by their first codepoint. Sequential runs map
+    `starts[i] + k` to `glyphs[i] + k`, constant runs map every codepoint
+    in the run to `glyphs[i]`.
+    '''
 
-    for sid in six.moves.range(seg_count):
-        if id_range_offset[sid] == 0:
-            for cid in six.moves.range(start_count[sid], end_count[sid] + 1):
-                cmap[cid] = (cid + id_delta[sid])  % 0x10000
+    def __init__(self, starts=None, ends=None, glyphs=None, constant=None):
+        self.starts = starts if starts is not None else array.array('I')
+        self.ends = ends if ends is not None else array.array('I')
+        self.glyphs = glyphs if glyphs is not None else array.array('I')
+        self.constant = constant if constant is not None else array.array('B', bytes(len(self.starts)))
+
+    @classmethod
+    def from_dense(cls, cmap, base=0):
+        r = cls()
+        run_start = None
+        for cid, gid in enumerate(cmap, base):
+            if run_start is not None and (gid == 0 or gid - cid != run_glyph - run_start):
+                r._append(run_start, cid - 1, run_glyph, 0)
+                run_start = None
+
+            if run_start is None and gid != 0:
+                run_start = cid
+                run_glyph = gid
+
+        if run_start is not None:
+            r._append(run_start, base + len(cmap) - 1, run_glyph, 0)
+        return r
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _append(self, start, end, glyph, constant):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.glyphs.append(glyph)
+        self.constant.append(constant)
+
+    def is_sorted(self):
+        starts = self.starts
+        ends = self.ends
+        return all(ends[i] < starts[i + 1] for i in six.moves.range(len(starts) - 1))
+
+    def lookup(self, cid):
+        idx = bisect.bisect_right(self.starts, cid) - 1
+        if idx < 0 or self.ends[idx] < cid:
+            return 0
+        glyph = self.glyphs[idx]
+        if not self.constant[idx]:
+            glyph += cid - self.starts[idx]
+
+        # Glyph ids past 0xffff can't exist, such codepoints are unmapped
+        # as in `dense`.
+        return glyph if glyph <= 0xffff else 0
+
+    def lookup_many(self, cids):
+        # `lookup` of each of the codepoints in the int64 array `cids`.
+        gids = numpy.zeros(len(cids), dtype=numpy.int64)
+        if not len(self.starts):
+            return gids
+
+        idx = numpy.searchsorted(numpy.frombuffer(self.starts, dtype=numpy.uint32), cids, side='right') - 1
+        found = idx >= 0
+        idx = numpy.maximum(idx, 0)
+        found &= numpy.frombuffer(self.ends, dtype=numpy.uint32)[idx] >= cids
+
+        starts = numpy.frombuffer(self.starts, dtype=numpy.uint32)[idx].astype(numpy.int64)
+        glyphs = numpy.frombuffer(self.glyphs, dtype=numpy.uint32)[idx].astype(numpy.int64)
+        constant = numpy.frombuffer(self.constant, dtype=numpy.uint8)[idx] != 0
+        gids[found] = numpy.where(constant, glyphs, glyphs + cids - starts)[found]
+        gids[gids > 0xffff] = 0
+        return gids
+
+    def split(self, cid):
+        '''
+        Returns the runs covering codepoints from `cid` on.
+        '''
+
+        idx = bisect.bisect_right(self.ends, cid - 1)
+        r = _CmapRuns(self.starts[idx:], self.ends[idx:], self.glyphs[idx:], self.constant[idx:])
+        if r.starts and r.starts[0] < cid:
+            if not r.constant[0]:
+                r.glyphs[0] += cid - r.starts[0]
+            r.starts[0] = cid
+        return r
+
+    def __setitem__(self, cid, gid):
+        idx = bisect.bisect_right(self.starts, cid) - 1
+        if idx >= 0 and cid <= self.ends[idx]:
+            start, end, glyph, constant = self.starts[idx], self.ends[idx], self.glyphs[idx], self.constant[idx]
+            del self.starts[idx], self.ends[idx], self.glyphs[idx], self.constant[idx]
+
+            pieces = []
+            if start < cid:
+                pieces.append((start, cid - 1, glyph, constant))
+            if cid < end:
+                pieces.append((cid + 1, end, glyph if constant else glyph + cid + 1 - start, constant))
+            for piece in reversed(pieces):
+                self._insert(idx, *piece)
+
+            if start < cid:
+                idx += 1
         else:
-            adj = start_count[sid] + seg_count - sid - id_range_offset[sid] // 2
-            for cid in six.moves.range(start_count[sid], end_count[sid] + 1):
-                glyph = glyph_ids[cid - adj]
-                if glyph != 0:
-                    glyph += id_delta[sid]
-                cmap[cid] = glyph % 0x10000
+            idx += 1
+
+        if gid != 0:
+            self._insert(idx, cid, cid, gid, 0)
+
+    def _insert(self, idx, start, end, glyph, constant):
+        self.starts.insert(idx, start)
+        self.ends.insert(idx, end)
+        self.glyphs.insert(idx, glyph)
+        self.constant.insert(idx, constant)
+
+    def items(self):
+        return six.moves.zip(self.starts, self.ends, self.glyphs, self.constant)
+
+    def dense(self):
+        cmap = _empty_map()
+        for start, end, glyph, constant in self.items():
+            if start >= 0x10000:
+                break
+            end = min(end, 0xffff)
+            if constant:
+                if glyph <= 0xffff:
+                    cmap[start:end + 1] = array.array('H', [glyph]) * (end + 1 - start)
+            else:
+                # Glyph ids past 0xffff can't exist, such codepoints stay unmapped.
+                end = min(end, start + 0xffff - glyph)
+                cmap[start:end + 1] = _identity[glyph:glyph + end + 1 - start]
+        return cmap
+
+def _parse_format12(blob, offs, constant=0):
+    hdr = _cmap_fmt12_header.parse_blob(blob, offs)
+    if hdr.length != hdr.size + hdr.numGroups * 12:
+        raise RuntimeError('corrupted character map subtable')
+
+    groups = read_array(blob, offs + hdr.size, hdr.numGroups * 3, 'I')
+    runs = _CmapRuns(groups[0::3], groups[1::3], groups[2::3], array.array('B', bytes([constant]) * hdr.numGroups))
+
+    if any(runs.starts[i] > runs.starts[i + 1] for i in six.moves.range(len(runs) - 1)):
+        order = sorted(six.moves.range(len(runs)), key=runs.starts.__getitem__)
+        runs = _CmapRuns(*(array.array(a.typecode, (a[i] for i in order)) for a in (runs.starts, runs.ends, runs.glyphs, runs.constant)))
 
-    return cmap
+    return runs
+
+def _parse_format13(blob, offs):
+    return _parse_format12(blob, offs, constant=1)
 
 _table_formats = {
     4: _parse_format4,
+    12: _parse_format12,
+    13: _parse_format13,
     }
 
+# Encoding records in the order of preference, full-repertoire ones first.
+_encodings = [
+    (3, 10),
+    (0, 6),
+    (0, 4),
+    (3, 1),
+    (0, 3),
+    ]
+
+def _find_runs(cmap):
+    # Returns the starts and ends of the maximal runs of mapped codepoints
+    # whose glyphs go up by one along with them; `cmap` is an array('H').
+    if numpy is not None:
+        gids = numpy.frombuffer(cmap, dtype=numpy.uint16)
+        delta = gids.astype(numpy.int32) - numpy.arange(len(gids), dtype=numpy.int32)
+        mapped = gids != 0
+        joined = mapped[:-1] & mapped[1:] & (delta[:-1] == delta[1:])
+
+        first = mapped.copy()
+        first[1:] &= ~joined
+        last = mapped.copy()
+        last[:-1] &= ~joined
+        return numpy.flatnonzero(first).tolist(), numpy.flatnonzero(last).tolist()
+
+    starts = []
+    ends = []
+    prev = None
+    for cid, gid in enumerate(cmap):
+        if prev is not None and (gid == 0 or gid - cid != prev):
+            ends.append(cid - 1)
+            prev = None
+        if prev is None and gid != 0:
+            starts.append(cid)
+            prev = gid - cid
+    if prev is not None:
+        ends.append(len(cmap) - 1)
+    return starts, ends
+
+def _plan_format4(starts, ends):
+    '''
+    Groups the runs into segments so that the subtable is as small as
+    possible. A run on its own is a delta segment of 8 bytes; consecutive
+    runs can share a segment backed by the glyph id array, which costs
+    8 bytes plus two for every codepoint it spans, gaps included. Returns
+    the (first run, last run) of each segment.
+    '''
+
+    # cost[j] is the size of the best plan for the first j runs; an array
+    # segment spanning runs i..j-1 costs 8 + 2 * (ends[j-1] - starts[i] + 1),
+    # so only the smallest cost[i] - 2 * starts[i] seen so far matters.
+    cost = [0]
+    choice = []
+    best_base = None
+    best_i = None
+    for j in six.moves.range(len(starts)):
+        base = cost[j] - 2 * starts[j]
+        if best_base is None or base < best_base:
+            best_base, best_i = base, j
+
+        delta_cost = cost[j] + 8
+        array_cost = best_base + 8 + 2 * (ends[j] + 1)
+        if array_cost < delta_cost:
+            cost.append(array_cost)
+            choice.append(best_i)
+        else:
+            cost.append(delta_cost)
+            choice.append(j)
+
+    groups = []
+    j = len(starts)
+    while j:
+        i = choice[j - 1]
+        groups.append((i, j - 1))
+        j = i
+    groups.reverse()
+    return groups
+
+def _pack_format4(cmap):
+    if not isinstance(cmap, array.array) or cmap.typecode != 'H':
+        cmap = array.array('H', cmap)
+    starts, ends = _find_runs(cmap)
+
+    # (start, end, delta, glyph ids or None)
+    segments = []
+    for i, j in _plan_format4(starts, ends):
+        start, end = starts[i], ends[j]
+        if i == j:
+            segments.append((start, end, (cmap[start] - start) & 0xffff, None))
+        else:
+            segments.append((start, end, 0, cmap[start:end + 1]))
+
+    # The last segment must end at U+FFFF.
+    if not segments or segments[-1][1] != 0xffff:
+        segments.append((0xffff, 0xffff, 1, None))
+
+    size = _cmap_fmt4_header.size + 2 + 8 * len(segments) + sum(2 * len(glyphs) for start, end, delta, glyphs in segments if glyphs is not None)
+    if size > 0xffff:
+        return None
+
+    glyph_ids = array.array('H')
+    id_range_offsets = []
+    for sid, (start, end, delta, glyphs) in enumerate(segments):
+        if glyphs is None:
+            id_range_offsets.append(0)
+        else:
+            id_range_offsets.append(2 * (len(segments) - sid + len(glyph_ids)))
+            glyph_ids.extend(glyphs)
+
+    seg_words = array.array('H')
+    seg_words.extend(end for start, end, delta, glyphs in segments)
+    seg_words.append(0)
+    seg_words.extend(start for start, end, delta, glyphs in segments)
+    seg_words.extend(delta for start, end, delta, glyphs in segments)
+    seg_words.extend(id_range_offsets)
+    seg_words.extend(glyph_ids)
+    if sys.byteorder == 'little':
+        seg_words.byteswap()
+
+    seg_spec = seg_words.tobytes()
+
+    entry_selector = int(math.floor(math.log2(len(segments))))
+    search_range = 2 * (2**entry_selector)
+
+    subheader = _cmap_fmt4_header(format=4, length=len(seg_spec) + _cmap_fmt4_header.size, language=0,
+        segCountX2=len(segments) * 2,
+        searchRange=search_range,
+        entrySelector=entry_selector,
+        rangeShift=len(segments) * 2 - search_range
+        ).pack()
+
+    return subheader + seg_spec
+
+def _format13_smaller(runs):
+    # Format 12 has to spell out constant runs codepoint by codepoint,
+    # format 13 sequential ones.
+    seq_cost = sum(1 if not constant else end + 1 - start for start, end, glyph, constant in runs.items())
+    const_cost = sum(1 if constant else end + 1 - start for start, end, glyph, constant in runs.items())
+    return const_cost < seq_cost
+
+def _pack_format12(runs, format=12):
+    groups = []
+    for start, end, glyph, constant in runs.items():
+        if bool(constant) == (format == 13) or start == end:
+            if format == 12 and groups and groups[-1][1] + 1 == start and groups[-1][2] + start - groups[-1][0] == glyph:
+                groups[-1][1] = end
+            elif format == 13 and groups and groups[-1][1] + 1 == start and groups[-1][2] == glyph:
+                groups[-1][1] = end
+            else:
+                groups.append([start, end, glyph])
+        elif format == 12:
+            groups.extend([cid, cid, glyph] for cid in six.moves.range(start, end + 1))
+        else:
+            groups.extend([cid, cid, glyph + cid - start] for cid in six.moves.range(start, end + 1))
+
+    words = [word for group in groups for word in group]
+    return _cmap_fmt12_header(format=format, reserved=0, length=_cmap_fmt12_header.size + 4 * len(words),
+        language=0, numGroups=len(groups)).pack() + struct.pack('>{}I'.format(len(words)), *words)
+
 class OtfCmapTable:
-    def __init__(self, name, blob):
+    def __init__(self, name, blob, lazy=True):
         self.name = name
+        self.dirty = False
 
-        fin = BlobIO(blob)
-
-        hdr = _cmap_header.parse(fin)
+        hdr = _cmap_header.parse_blob(blob)
         if hdr.version != 0:
             raise RuntimeError('unknown cmap table version, expected 0, found {}'.format(hdr.version))
 
-        enc_records = [_cmap_encodingRecord.parse(fin) for i in six.moves.range(hdr.numTables)]
+        enc_records = _cmap_encodingRecord.parse_many(blob, _cmap_header.size, hdr.numTables)
 
-        self._map = None
+        subtables = {}
         for enc in enc_records:
-            if enc.platformID != 3 or enc.encodingID != 1:
-                continue
-
-            format, = struct.unpack('>H', bytes(blob[enc.offset:enc.offset+2]))
+            format, = parse_at(blob, enc.offset, '>H')
+            if format in _table_formats:
+                subtables.setdefault((enc.platformID, enc.encodingID), (format, enc.offset))
+
+        for encoding in _encodings:
+            if encoding in subtables:
+                format, offset = subtables[encoding]
+                self._segments = _table_formats[format](blob, offset)
+                break
+        else:
+            raise RuntimeError('no supported character map subtable')
 
-            parser = _table_formats.get(format)
-            if parser is None:
-                raise RuntimeError('unknown table format')
+        if isinstance(self._segments, _CmapRuns):
+            self._supp = self._segments.split(0x10000)
+        else:
+            self._supp = _CmapRuns()
 
-            self._map = parser(blob, enc.offset)
-            break
+        self._map = None
 
-        self._inv_map = {}
-        for idx, gid in enumerate(self._map):
+        # Built on demand: the gid-indexed highest codepoint of each glyph,
+        # and the offsets and codepoints of all characters of each glyph.
+        self._inv = None
+        self._inv_multi = None
+
+        # Overlapping or unsorted segments can't be searched by bisection,
+        # decode them right away, later segments take precedence.
+        if not lazy or not self._segments.is_sorted():
+            self._dense()
+
+    def _cache_sections(self):
+        '''
+        Returns the decoded map and its inverse as the sections of
+        a `FontCache` entry.
+        '''
+
+        supp = self._supp
+        return [(b'map', self._dense()), (b'inv', self._inverse()),
+            (b'starts', supp.starts), (b'ends', supp.ends), (b'glyphs', supp.glyphs), (b'constant', supp.constant)]
+
+    @classmethod
+    def _from_cache(cls, name, blob, entry):
+        self = cls.__new__(cls)
+        self.name = name
+        self.dirty = False
+        self._segments = None
+        self._map = entry.array(b'map', 'H')
+        self._supp = _CmapRuns(entry.array(b'starts', 'I'), entry.array(b'ends', 'I'), entry.array(b'glyphs', 'I'), entry.array(b'constant', 'B'))
+        self._inv = entry.array(b'inv', 'I')
+        self._inv_multi = None
+        return self
+
+    def _dense(self):
+        if self._map is None:
+            self._map = self._segments.dense()
+            self._segments = None
+        return self._map
+
+    def _pairs(self):
+        # Returns the glyphs and the codepoints of all mapped codepoints,
+        # ordered by codepoint.
+        cmap = self._map if self._map is not None else self._segments.dense()
+
+        if numpy is not None:
+            view = numpy.frombuffer(cmap, dtype=numpy.uint16)
+            cids = [numpy.flatnonzero(view)]
+            gids = [view[cids[0]].astype(numpy.int64)]
+            for start, end, glyph, constant in self._supp.items():
+                run = numpy.arange(start, end + 1, dtype=numpy.int64)
+                cids.append(run)
+                gids.append(numpy.full(len(run), glyph, dtype=numpy.int64) if constant else run - start + glyph)
+            gids = numpy.concatenate(gids)
+            cids = numpy.concatenate(cids)
+            valid = gids <= 0xffff
+            return gids[valid], cids[valid]
+
+        gids = []
+        cids = []
+        for cid, gid in enumerate(cmap):
             if gid:
-                self._inv_map[gid] = chr(idx)
+                gids.append(gid)
+                cids.append(cid)
+        for start, end, glyph, constant in self._supp.items():
+            for cid in six.moves.range(start, end + 1):
+                gid = glyph if constant else glyph + cid - start
+                if gid <= 0xffff:
+                    gids.append(gid)
+                    cids.append(cid)
+        return gids, cids
+
+    def _inverse(self):
+        if self._inv is None:
+            self._inv = _inverse(*self._pairs())
+        return self._inv
 
     def inv(self, gids, repl='\uffff'):
-        return ''.join(self._inv_map.get(gid, repl) for gid in gids)
+        '''
+        Returns the characters of the glyphs `gids`, for each glyph the
+        highest codepoint mapped to it, or `repl` for unmapped glyphs.
+        '''
+
+        if numpy is not None and len(repl) == 1 and hasattr(gids, '__len__') and len(gids) >= _numpy_threshold:
+            return self.inv_many([gids], repl)[0]
+
+        inv = self._inverse()
+        if not isinstance(gids, (list, tuple, array.array)):
+            gids = list(gids)
+
+        # Unmapped or out of range glyphs make this raise, they take the
+        # slow path below.
+        try:
+            if not gids or min(gids) >= 0:
+                return ''.join(map(six.unichr, map(inv.__getitem__, gids)))
+        except (IndexError, ValueError, OverflowError):
+            pass
+
+        count = len(inv)
+        cids = [inv[gid] if 0 <= gid < count else _no_codepoint for gid in gids]
+        return ''.join([repl if cid == _no_codepoint else six.unichr(cid) for cid in cids])
+
+    def inv_many(self, runs, repl='\uffff'):
+        '''
+        Returns `inv` of each of the glyph sequences in `runs`. With NumPy,
+        all of the runs are looked up and decoded at once.
+        '''
+
+        runs = [run if hasattr(run, '__len__') else list(run) for run in runs]
+        if numpy is None or len(repl) != 1:
+            return [self.inv(run, repl) for run in runs]
+
+        lengths = numpy.fromiter((len(run) for run in runs), dtype=numpy.int64, count=len(runs))
+        gids = numpy.fromiter(itertools.chain.from_iterable(runs), dtype=numpy.int64, count=int(lengths.sum()))
+
+        inv = numpy.frombuffer(self._inverse(), dtype=numpy.uint32)
+        cids = numpy.full(len(gids), ord(repl), dtype='<u4')
+        valid = (gids >= 0) & (gids < len(inv))
+        found = inv[gids[valid]]
+        found[found == _no_codepoint] = ord(repl)
+        cids[valid] = found
+
+        text = cids.tobytes().decode('utf-32-le', 'surrogatepass')
+        ends = numpy.cumsum(lengths).tolist()
+        return [text[end - length:end] for end, length in zip(ends, lengths.tolist())]
+
+    def inv_all(self, gids):
+        '''
+        Returns, for each of the glyphs `gids`, a string of all the
+        characters mapped to it in codepoint order.
+        '''
+
+        if self._inv_multi is None:
+            gids_, cids = self._pairs()
+            if numpy is not None:
+                order = numpy.argsort(gids_, kind='stable')
+                counts = numpy.bincount(gids_, minlength=0x10000)
+                offsets = numpy.concatenate(([0], numpy.cumsum(counts))).astype(numpy.uint32)
+                self._inv_multi = array.array('I', offsets.tobytes()), array.array('I', cids[order].astype(numpy.uint32).tobytes())
+            else:
+                pairs = sorted(zip(gids_, cids))
+                counts = [0] * 0x10000
+                for gid, cid in pairs:
+                    counts[gid] += 1
+                offsets = array.array('I', [0])
+                for count in counts:
+                    offsets.append(offsets[-1] + count)
+                self._inv_multi = offsets, array.array('I', [cid for gid, cid in pairs])
+
+        offsets, cids = self._inv_multi
+        return [''.join(six.unichr(cid) for cid in cids[offsets[gid]:offsets[gid + 1]]) if 0 <= gid < 0x10000 else ''
+            for gid in gids]
 
     def pack(self):
-        segments = []
-
-        seg_cid = None
-        seg_gid = None
-        for cid, gid in enumerate(self._map):
-            if seg_cid is not None and (gid == 0 or cid - seg_cid + seg_gid != gid):
-                segments.append((seg_cid, seg_gid, cid - seg_cid))
-                seg_cid = None
-
-            if seg_cid is None and gid != 0:
-                seg_cid = cid
-                seg_gid = gid
-
-        if seg_cid is not None:
-                segments.append((seg_cid, seg_gid, cid - seg_cid))
-
-        segments.append((0xffff, 0, 1))
-
-        seg_words = []
-        seg_words.extend(cid + length - 1 for cid, gid, length in segments)
-        seg_words.append(0)
-        seg_words.extend(cid for cid, gid, length in segments)
-        seg_words.extend((gid - cid) & 0xffff for cid, gid, length in segments)
-        seg_words.extend(0 for cid, gid, length in segments)
-
-        seg_spec = struct.pack('>{}H'.format(len(seg_words)), *seg_words)
-
-        hdr = _cmap_header(version=0, numTables=1).pack()
-        record = _cmap_encodingRecord(platformID=3, encodingID=1, offset=_cmap_header.size + _cmap_encodingRecord.size).pack()
-
-        entry_selector = int(math.floor(math.log2(len(segments))))
-        search_range = 2 * (2**entry_selector)
-
-        subheader = _cmap_fmt4_header(format=4, length=len(seg_spec) + _cmap_fmt4_header.size, language=0,
-            segCountX2=len(segments) * 2,
-            searchRange=search_range,
-            entrySelector=entry_selector,
-            rangeShift=len(segments) * 2 - search_range
-            ).pack()
-
-        return rope(hdr, record, subheader, seg_spec)
+        cmap = self._dense()
+
+        subtables = []
+
+        # The BMP subtable is left out if it can't fit into format 4,
+        # the format 12 one then covers the BMP as well.
+        bmp_subtable = _pack_format4(cmap)
+        if bmp_subtable is not None:
+            subtables.append((3, 1, bmp_subtable))
+
+        if len(self._supp) or bmp_subtable is None:
+            runs = _CmapRuns.from_dense(cmap)
+            for item in self._supp.items():
+                runs._append(*item)
+            subtables.append((3, 10, _pack_format12(runs)))
+
+            # Windows only reads format 12 under (3,10), a smaller format 13
+            # subtable goes under the Unicode platform's full repertoire
+            # encoding, which readers preferring it pick up.
+            if _format13_smaller(runs):
+                subtables.insert(0, (0, 6, _pack_format12(runs, 13)))
+
+        offset = _cmap_header.size + _cmap_encodingRecord.size * len(subtables)
+        records = []
+        for idx, (platform_id, encoding_id, subtable) in enumerate(subtables):
+            if idx + 1 < len(subtables) and len(subtable) % 4:
+                subtable += b'\0' * (4 - len(subtable) % 4)
+                subtables[idx] = platform_id, encoding_id, subtable
+            records.append(_cmap_encodingRecord(platformID=platform_id, encodingID=encoding_id, offset=offset).pack())
+            offset += len(subtable)
+
+        hdr = _cmap_header(version=0, numTables=len(subtables)).pack()
+        return rope(hdr, *records, *(subtable for platform_id, encoding_id, subtable in subtables))
 
     def __getitem__(self, key):
-        return self._map[ord(key)]
+        cid = ord(key)
+        if cid >= 0x10000:
+            return self._supp.lookup(cid)
+        if self._map is None:
+            return self._segments.lookup(cid)
+        return self._map[cid]
 
     def __setitem__(self, key, value):
-        self._map[ord(key)] = value
+        if not 0 <= value <= 0xffff:
+            raise OverflowError('glyph id out of range')
+
+        self.dirty = True
+        cid = ord(key)
+        if cid >= 0x10000:
+            old = self._supp.lookup(cid)
+            self._supp[cid] = value
+        else:
+            cmap = self._dense()
+            old = cmap[cid]
+            cmap[cid] = value
+
+        self._inv_multi = None
+        if self._inv is not None:
+            self._inv_update([cid], [old], [value])
+
+    def lookup_many(self, cids):
+        '''
+        Returns the glyph ids of the codepoints `cids`, a string or
+        a sequence of ints, as an array('H').
+        '''
+
+        cids = _codepoints(cids)
+        if numpy is not None and isinstance(cids, numpy.ndarray):
+            bmp = cids < 0x10000
+            gids = numpy.zeros(len(cids), dtype=numpy.uint16)
+            if self._map is not None:
+                gids[bmp] = numpy.frombuffer(self._map, dtype=numpy.uint16)[cids[bmp]]
+            else:
+                # Searched in the segments, as `__getitem__` does, rather
+                # than decoding the whole map.
+                gids[bmp] = self._segments.lookup_many(cids[bmp])
+            for idx in numpy.flatnonzero(~bmp).tolist():
+                gids[idx] = self._supp.lookup(int(cids[idx]))
+            return array.array('H', gids.tobytes())
+
+        if self._map is None and len(cids) < _numpy_threshold:
+            lookup = self._segments.lookup
+            return array.array('H', [lookup(cid) if cid < 0x10000 else self._supp.lookup(cid) for cid in cids])
+
+        cmap = self._dense()
+        return array.array('H', [cmap[cid] if cid < 0x10000 else self._supp.lookup(cid) for cid in cids])
+
+    def update(self, mapping):
+        '''
+        Sets the glyphs of many codepoints at once. `mapping` is a dict or
+        a sequence of pairs; keys are characters or codepoints, a glyph id
+        of 0 unmaps the codepoint. Later pairs win.
+        '''
+
+        items = mapping.items() if hasattr(mapping, 'items') else mapping
+        cids = []
+        gids = []
+        for key, gid in items:
+            cids.append(key if isinstance(key, six.integer_types) else ord(key))
+            gids.append(gid)
+        self._assign(cids, gids)
+
+    def remap_codepoints(self, src, dst):
+        '''
+        Maps each codepoint in `dst` to the glyph that the codepoint at the
+        same index in `src` maps to. Both are strings or sequences of ints.
+        All glyphs are looked up before any is assigned, so the two may
+        overlap, e.g. to shift a range of characters.
+        '''
+
+        src = _codepoints(src)
+        dst = _codepoints(dst)
+        if len(src) != len(dst):
+            raise RuntimeError('the source and destination codepoints differ in length')
+        self._assign(dst, self.lookup_many(src))
+
+    def permute_glyphs(self, perm):
+        '''
+        Replaces each glyph id `gid` in the table with `perm[gid]`. `perm`
+        must cover every glyph id in use; glyph 0 stays unmapped.
+        '''
+
+        self.dirty = True
+        cmap = self._dense()
+        if numpy is not None:
+            perm = numpy.asarray(perm, dtype=numpy.uint16)
+            view = numpy.frombuffer(cmap, dtype=numpy.uint16)
+            view[:] = numpy.where(view != 0, perm[view], 0)
+            perm = perm.tolist()
+        else:
+            cmap[:] = array.array('H', [perm[gid] if gid else 0 for gid in cmap])
+
+        supp = _CmapRuns()
+        for start, end, glyph, constant in self._supp.items():
+            if constant:
+                if perm[glyph]:
+                    supp._append(start, end, perm[glyph], 1)
+            else:
+                for item in _CmapRuns.from_dense([perm[gid] for gid in six.moves.range(glyph, glyph + end + 1 - start)], start).items():
+                    supp._append(*item)
+        self._supp = supp
+
+        self._inv_multi = None
+        if self._inv is not None:
+            gids = [gid for gid, cid in enumerate(self._inv) if cid != _no_codepoint]
+            self._inv = _inverse([perm[gid] for gid in gids], [self._inv[gid] for gid in gids])
+
+    def _assign(self, cids, gids):
+        # Checked before anything is written, so that a failure leaves both
+        # the map and its inverse as they were.
+        use_numpy = numpy is not None and len(cids) >= _numpy_threshold
+        if use_numpy:
+            cids = numpy.asarray(cids, dtype=numpy.int64)
+            gids = numpy.asarray(gids, dtype=numpy.int64)
+            if len(gids) and (gids.min() < 0 or gids.max() > 0xffff):
+                raise OverflowError('glyph id out of range')
+        elif any(not 0 <= gid <= 0xffff for gid in gids):
+            raise OverflowError('glyph id out of range')
+
+        self.dirty = True
+        cmap = self._dense()
+
+        old = array.array('H')
+        if use_numpy:
+            # Only the last glyph given for a codepoint counts.
+            unique, last = numpy.unique(cids[::-1], return_index=True)
+            if len(unique) < len(cids):
+                keep = numpy.sort(len(cids) - 1 - last)
+                cids, gids = cids[keep], gids[keep]
+
+            bmp = cids < 0x10000
+            view = numpy.frombuffer(cmap, dtype=numpy.uint16)
+            old_bmp = view[cids[bmp]]
+            view[cids[bmp]] = gids[bmp]
+
+            old = numpy.zeros(len(cids), dtype=numpy.int64)
+            old[bmp] = old_bmp
+            for idx in numpy.flatnonzero(~bmp).tolist():
+                old[idx] = self._supp.lookup(int(cids[idx]))
+                self._supp[int(cids[idx])] = int(gids[idx])
+            cids, old, gids = cids.tolist(), old.tolist(), gids.tolist()
+        else:
+            for cid, gid in zip(cids, gids):
+                if cid < 0x10000:
+                    old.append(cmap[cid])
+                    cmap[cid] = gid
+                else:
+                    old.append(self._supp.lookup(cid))
+                    self._supp[cid] = gid
+
+        self._inv_multi = None
+        if self._inv is not None:
+            self._inv_update(cids, old, gids)
+
+    def _inv_update(self, cids, old_gids, new_gids):
+        # The inverse maps each glyph to the highest codepoint mapped to it.
+        # A glyph that loses that codepoint is looked up again, all such
+        # glyphs in a single pass over the map.
+        inv = self._inv
+        stale = set()
+        for cid, old, new in zip(cids, old_gids, new_gids):
+            if old == new:
+                continue
+            if old and inv[old] == cid:
+                stale.add(old)
+            if new and (inv[new] == _no_codepoint or inv[new] < cid):
+                inv[new] = cid
+
+        if stale:
+            for gid in stale:
+                inv[gid] = _no_codepoint
+            for cid, gid in self._mapped(stale):
+                inv[gid] = cid
+
+    def _mapped(self, gids):
+        # Yields the (codepoint, glyph) pairs mapping to `gids`, by codepoint.
+        cmap = self._dense()
+        if numpy is not None:
+            view = numpy.frombuffer(cmap, dtype=numpy.uint16)
+            cids = numpy.flatnonzero(numpy.isin(view, numpy.fromiter(gids, dtype=numpy.uint16, count=len(gids))))
+            for cid, gid in zip(cids.tolist(), view[cids].tolist()):
+                yield cid, gid
+        else:
+            for cid, gid in enumerate(cmap):
+                if gid in gids:
+                    yield cid, gid
+
+        for start, end, glyph, constant in self._supp.items():
+            if constant:
+                if glyph in gids:
+                    yield end, glyph
+            else:
+                for gid in gids:
+                    if glyph <= gid <= glyph + end - start:
+                        yield start + gid - glyph, gid
+
@@ -1,8 +1,16 @@
-import grope, six, math, struct
+import grope, six, math, struct, array, sys, os, io, stat, errno
+import concurrent.futures
+import mmap as _mmap
 from grope import rope
-from .struct2 import struct_be
+from .struct2 import struct_be, read_array
 from .cmap import OtfCmapTable
 from .adv_typo import OtfGsubTable
+from .stats import Stats, _clock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 @struct_be
 class _OTF_OFFSET_TABLE:
@@ -46,6 +54,15 @@ class _OTF_head:
     h:glyphDataFormat
     '''
 
+@struct_be
+class _TTC_HEADER:
+    '''
+    4s:ttcTag
+    H:majorVersion
+    H:minorVersion
+    I:numFonts
+    '''
+
 def _align4(v):
     return (v + 3) & ~3
 
@@ -53,6 +70,8 @@ def _pad4(v):
     return b'\0' * (_align4(v) - v)
 
 class OtfUnparsedTable:
+    dirty = False
+
     def __init__(self, name, blob):
         self.name = name
         self.blob = blob
@@ -64,6 +83,8 @@ class OtfUnparsedTable:
         return 'OtfUnparsedTable(name={!r}, blob={!r})'.format(self.name, self.blob)
 
 class OtfUnparsableTable:
+    dirty = False
+
     def __init__(self, name, blob):
         self.name = name
         self.blob = blob
@@ -86,100 +107,615 @@ _table_parsers = {
     b'GSUB': OtfGsubTable,
     }
 
-def _otf_table_checksum(b):
+def _buffers(b):
+    chunks = b.chunks if isinstance(b, rope) else (b,)
+    for chunk in chunks:
+        try:
+            buf = memoryview(chunk)
+        except TypeError:
+            buf = memoryview(bytes(chunk))
+        if buf.format != 'B' or buf.ndim != 1:
+            buf = buf.cast('B')
+        yield buf
+
+# The array fallback byteswaps a copy of the data, this many bytes at a time.
+_checksum_block = 1024*1024
+
+def _sum_words(buf):
+    if numpy is not None:
+        return int(numpy.frombuffer(buf, dtype='>u4').sum(dtype=numpy.uint64))
+
+    if sys.byteorder == 'big':
+        return sum(buf.cast('I'))
+
     r = 0
-    while b:
-        chunk_len = min(len(b), 16*1024)
-        if chunk_len < 4:
-            item,  = struct.unpack('>I', bytes(b) + _pad4(len(b)))
-            r += item
-            break
+    for offs in six.moves.range(0, len(buf), _checksum_block):
+        words = array.array('I')
+        words.frombytes(buf[offs:offs + _checksum_block])
+        words.byteswap()
+        r += sum(words)
+    return r
 
-        chunk_len = chunk_len & ~3
-        items = struct.unpack('>{}I'.format(chunk_len // 4), bytes(b[:chunk_len]))
+def _otf_table_checksum(b):
+    r = 0
 
-        r = (r + sum(items)) & 0xffffffff
-        b = b[chunk_len:]
+    # Words may straddle chunk boundaries, the leading bytes of such
+    # a word are carried over to the next chunk.
+    tail = b''
+    for buf in _buffers(b):
+        if tail:
+            head = 4 - len(tail)
+            tail += buf[:head].tobytes()
+            buf = buf[head:]
+            if len(tail) < 4:
+                continue
+            r += struct.unpack('>I', tail)[0]
+
+        aligned = len(buf) & ~3
+        r += _sum_words(buf[:aligned])
+        tail = buf[aligned:].tobytes()
+
+    if tail:
+        r += struct.unpack('>I', tail + _pad4(len(tail)))[0]
 
     return r & 0xffffffff
 
+def _unpack_directory(blob, offset, count):
+    return [(rec.tag, rec.checkSum, rec.offset, rec.length) for rec in _OTF_TABLE_RECORD.parse_many(blob, offset, count)]
+
+def _fileno(f):
+    try:
+        fd = f.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    return fd
+
+def _copy_range(source_fd, fout, dest_fd, offset, length, pos):
+    '''
+    Copies `length` bytes at `offset` in the source file to `pos` in `fout`
+    without passing them through user space. Returns False if the kernel
+    can't do that, before anything has been written.
+    '''
+
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    if copy_file_range is None and sendfile is None:
+        return False
+
+    # Flushes pending writes and moves the descriptor to `pos`.
+    fout.seek(pos)
+
+    done = 0
+    while done < length:
+        try:
+            if copy_file_range is not None:
+                n = copy_file_range(source_fd, dest_fd, length - done, offset + done)
+            else:
+                n = sendfile(dest_fd, source_fd, offset + done, length - done)
+        except OSError as e:
+            if done != 0 or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                raise
+            if copy_file_range is not None and sendfile is not None:
+                copy_file_range = None
+                continue
+            fout.seek(pos)
+            return False
+
+        if n == 0:
+            raise IOError('reached eof prematurely')
+        done += n
+
+    # Resynchronizes the file object with the descriptor.
+    fout.seek(pos + length)
+    return True
+
+def _shape_batch(font, texts, features, clusters):
+    cmap = font.get(b'cmap')
+    subber = font.get(b'GSUB').make_subber(features)
+
+    # The whole batch goes through the cmap at once, then it is split back
+    # into the texts.
+    texts = [_text(text) for text in texts]
+    all_gids = cmap.lookup_many(u''.join(texts))
+    bounds = [0]
+    for text in texts:
+        bounds.append(bounds[-1] + len(text))
+    gids = [all_gids[start:end] for start, end in zip(bounds, bounds[1:])]
+
+    if clusters:
+        r = []
+        for text_gids in gids:
+            buf = subber.shape(text_gids)
+            r.append((buf.gids, buf.clusters))
+        return r
+    return [subber.sub(text_gids) for text_gids in gids]
+
+def _text(chars):
+    # Characters may also come as any sequence of one-character strings.
+    return chars if isinstance(chars, six.text_type) else u''.join(chars)
+
+# The font of a shaping worker process, parsed once when the worker starts.
+_worker_font = None
+
+def _init_shaping_worker(data, cache):
+    global _worker_font
+    _worker_font = OpenTypeFont.parse(io.BytesIO(data), cache=cache)
+
+def _shape_chunk(args):
+    texts, features, clusters = args
+    return _shape_batch(_worker_font, texts, features, clusters)
+
 class OpenTypeFont:
-    def __init__(self, tables):
+    def __init__(self, tables, checksums=None):
         self._tables = tables
-        self._head = self.get(b'head')
+
+        if checksums is None:
+            checksums = {}
+
+        # The original bytes and checksums of the tables, these are written
+        # out unchanged for tables that weren't modified since.
+        self._sources = { tab.name: (checksums.get(tab.name), tab.blob) for tab in tables if isinstance(tab, OtfUnparsedTable) }
+        self._source_file = None
+        self._source_offsets = {}
+        self._owns_source = False
+        self._mmap = None
+
+        # Parsed tables by (tag, source offset), faces of a collection share
+        # this, so that tables they have in common are only parsed once.
+        self._shared = {}
+
+        self._index = { tab.name: idx for idx, tab in enumerate(tables) }
+
+        self.stats = None
+
+        # A `FontCache` that tables are loaded from when they are parsed.
+        self.cache = None
 
     @staticmethod
-    def parse(fin):
+    def parse(fin, cache=None):
+        '''
+        Reads a font from the file object `fin`, tables are parsed when
+        first requested. With a `FontCache` given, tables found there are
+        loaded instead of parsed and those parsed are stored.
+        '''
+
         fin.seek(0)
 
         hdr = _OTF_OFFSET_TABLE.parse(fin)
-        table_hdrs = [_OTF_TABLE_RECORD.parse(fin) for i in six.moves.range(hdr.numTables)]
-        table_hdrs.sort(key=lambda tab: tab.offset)
+        directory = fin.read(_OTF_TABLE_RECORD.size * hdr.numTables)
+        return OpenTypeFont._from_directory(_unpack_directory(directory, 0, hdr.numTables), grope.wrap_io(fin), fin, cache=cache)
 
-        blob = grope.wrap_io(fin)
-        tables = [OtfUnparsedTable(tab.tag, blob[tab.offset:tab.offset + tab.length]) for tab in table_hdrs]
-        return OpenTypeFont(tables)
+    @staticmethod
+    def open(path, mmap=True, cache=None):
+        '''
+        Opens the font file at `path`. With `mmap` set, the file is mapped
+        into memory and table blobs are slices of the mapping; otherwise the
+        file is read on demand as with `parse`. The font owns the file,
+        call `close` or use the font as a context manager to release it.
+        '''
+
+        fin = open(path, 'rb')
+        try:
+            if not mmap:
+                font = OpenTypeFont.parse(fin, cache)
+            else:
+                mapping = _mmap.mmap(fin.fileno(), 0, access=_mmap.ACCESS_READ)
+                blob = memoryview(mapping)
+
+                hdr = _OTF_OFFSET_TABLE.parse_blob(blob)
+                font = OpenTypeFont._from_directory(_unpack_directory(blob, _OTF_OFFSET_TABLE.size, hdr.numTables), blob, fin, cache=cache)
+                font._mmap = mapping
+
+            font._owns_source = True
+            return font
+        except:
+            fin.close()
+            raise
+
+    @staticmethod
+    def _from_directory(table_hdrs, blob, fin, shared=None, cache=None):
+        table_hdrs.sort(key=lambda tab: tab[2])
+
+        tables = [OtfUnparsedTable(tag, blob[offset:offset + length]) for tag, checksum, offset, length in table_hdrs]
+        font = OpenTypeFont(tables, { tag: checksum for tag, checksum, offset, length in table_hdrs })
+        font._source_file = fin
+        font._source_offsets = { tag: offset for tag, checksum, offset, length in table_hdrs }
+        font.cache = cache
+        if shared is not None:
+            font._shared = shared
+        return font
+
+    def close(self):
+        self._tables = []
+        self._index = {}
+        self._sources = {}
+        self._shared = {}
+
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Parsed tables still reference the mapping, it is released
+                # along with them.
+                pass
+            self._mmap = None
+
+        if self._source_file is not None and self._owns_source:
+            self._source_file.close()
+        self._source_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def get(self, table_name):
-        for i, table in enumerate(self._tables):
-            if table.name == table_name:
-                break
-        else:
+        i = self._index.get(table_name)
+        if i is None:
             return None
 
+        table = self._tables[i]
         if isinstance(table, OtfUnparsedTable):
-            table = _table_parsers.get(table_name, OtfUnparsableTable)(table_name, table.blob)
+            key = table_name, self._source_offsets.get(table_name)
+            parsed = self._shared.get(key) if key[1] is not None else None
+            if parsed is None:
+                if self.stats is not None:
+                    start = _clock()
+                parser = _table_parsers.get(table_name, OtfUnparsableTable)
+                if self.cache is not None:
+                    parsed = self.cache.load_table(table_name, table.blob, parser)
+                else:
+                    parsed = parser(table_name, table.blob)
+                if self.stats is not None:
+                    self.stats._parsed(table_name, _clock() - start)
+                if key[1] is not None:
+                    self._shared[key] = parsed
+            if self.stats is not None and hasattr(parsed, 'set_stats'):
+                parsed.set_stats(self.stats)
+            table = parsed
             self._tables[i] = table
 
         return table
 
+    def enable_stats(self, callback=None):
+        '''
+        Starts collecting a `Stats` of table parsing, shaping and saving,
+        and returns it. Subbers made before this call stay uninstrumented.
+        '''
+
+        self.stats = Stats(callback)
+        for table in self._tables:
+            if hasattr(table, 'set_stats'):
+                table.set_stats(self.stats)
+        return self.stats
+
+    def disable_stats(self):
+        self.stats = None
+        for table in self._tables:
+            if hasattr(table, 'set_stats'):
+                table.set_stats(None)
+
+    def _sync_shared(self):
+        # Picks up tables that other faces of the collection have parsed.
+        for i, table in enumerate(self._tables):
+            if isinstance(table, OtfUnparsedTable) and (table.name, self._source_offsets.get(table.name)) in self._shared:
+                self.get(table.name)
+
+    def get_glyphs_many(self, texts, features=frozenset(), clusters=False, workers=None, chunksize=None):
+        '''
+        Shapes each of `texts` as `get_glyphs` would and returns the results
+        in input order. The subber is compiled once for the whole batch.
+
+        With `workers` set, the texts are shaped in a pool of that many
+        processes. Each worker receives the font once, when it starts, and
+        is then sent chunks of `chunksize` texts; `features` must be
+        a collection of tags rather than a predicate. Workers load tables
+        from the font's `cache`, if it has one.
+        '''
+
+        texts = list(texts)
+        if not workers or workers <= 1 or len(texts) < 2:
+            return _shape_batch(self, texts, features, clusters)
+
+        if callable(features):
+            raise RuntimeError('features must be a collection of tags when shaping in worker processes')
+        features = frozenset(features)
+
+        if chunksize is None:
+            chunksize = max(1, -(-len(texts) // (4 * workers)))
+        chunks = [texts[idx:idx + chunksize] for idx in six.moves.range(0, len(texts), chunksize)]
+
+        data = bytes(self.save())
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(chunks)),
+                initializer=_init_shaping_worker, initargs=(data, self.cache)) as executor:
+            results = executor.map(_shape_chunk, [(chunk, features, clusters) for chunk in chunks])
+            return [r for chunk in results for r in chunk]
+
     def inv_glyphs(self, gids):
         cmap = self.get(b'cmap')
         return cmap.inv(gids)
 
-    def get_glyphs(self, chars):
+    def inv_glyphs_many(self, runs):
         cmap = self.get(b'cmap')
-        gids = [cmap[ch] for ch in chars]
+        return cmap.inv_many(runs)
+
+    def get_glyphs(self, chars, features=frozenset(), clusters=False):
+        '''
+        Maps `chars` to glyphs and applies the enabled GSUB features. With
+        `clusters` set, returns a `(gids, clusters)` pair, where `clusters[i]`
+        is the index into `chars` of the first character of the `i`-th glyph.
+        '''
+
+        cmap = self.get(b'cmap')
+        gids = cmap.lookup_many(_text(chars))
 
         gsub = self.get(b'GSUB')
-        subber = gsub.make_subber(lambda name: False)
+        subber = gsub.make_subber(features)
+        if clusters:
+            buf = subber.shape(gids)
+            return buf.gids, buf.clusters
         return subber.sub(gids)
 
-    def save(self):
-        log_num_tables = int(math.floor(math.log2(len(self._tables))))
+    def _table_data(self, tab):
+        '''
+        Returns the blob and checksum of the table and, if the blob is
+        a verbatim copy of a table in the source file, its offset there.
+        '''
+
+        source = self._sources.get(tab.name)
+        if tab.name == b'head' or source is None or getattr(tab, 'dirty', True):
+            blob = tab.pack()
+            return blob, _otf_table_checksum(blob), None
+
+        checksum, blob = source
+        if checksum is None:
+            checksum = _otf_table_checksum(blob)
+            self._sources[tab.name] = checksum, blob
+        return blob, checksum, self._source_offsets.get(tab.name)
+
+    def _directory(self, records):
+        log_num_tables = int(math.floor(math.log2(len(records))))
 
         hdr = _OTF_OFFSET_TABLE(
             sfntVersion=0x10000,
-            numTables=len(self._tables),
+            numTables=len(records),
             searchRange=2**log_num_tables * 16,
             entrySelector=log_num_tables,
-            rangeShift=(len(self._tables) - 2**log_num_tables) * 16)
+            rangeShift=(len(records) - 2**log_num_tables) * 16)
+
+        table_hdrs = sorted(_OTF_TABLE_RECORD(tag=tag, checkSum=checksum, offset=offset, length=length).pack()
+            for tag, checksum, offset, length in records)
+        return hdr.pack() + b''.join(table_hdrs)
 
-        table_blobs = [tab.pack() for tab in self._tables]
-        table_hdrs = []
+    def _layout(self):
+        '''
+        Returns the header with the table directory, and for each table its
+        blob and, if the blob is a verbatim copy of a table in the source
+        file, its offset there.
+        '''
 
-        blobs_with_pad = []
+        head = self.get(b'head')
 
-        head_offset = None
+        tables = []
+        records = []
+        head_index = None
 
         data_offset = _OTF_OFFSET_TABLE.size + _OTF_TABLE_RECORD.size * len(self._tables)
-        for tab, blob in zip(self._tables, table_blobs):
-            if tab.name == b'head':
-                head_offset = data_offset
+        for idx, tab in enumerate(self._tables):
+            if tab is head:
+                head_index = idx
 
-            table_hdrs.append((tab.name, _OTF_TABLE_RECORD(tag=tab.name, checkSum=_otf_table_checksum(blob), offset=data_offset, length=len(blob)).pack()))
-            blobs_with_pad.append(blob)
-            blobs_with_pad.append(_pad4(len(blob)))
+            blob, checksum, source_offset = self._table_data(tab)
+            tables.append((blob, source_offset))
+            records.append((tab.name, checksum, data_offset, len(blob)))
             data_offset += _align4(len(blob))
 
-        table_hdrs.sort()
+        # Tables start at 4-byte boundaries and are padded with zeros, so the
+        # checksum of the font is the sum of the table checksums and that of
+        # the header and the table directory.
+        directory = self._directory(records)
+        full_checksum = _otf_table_checksum(directory) + sum(checksum for tag, checksum, offset, length in records)
+        tables[head_index] = head.pack(checksum=(0x1b1b0afba - full_checksum) & 0xffffffff), None
 
-        pre_full_checksum = rope(
-            hdr.pack(),
-            *(blob for name, blob in table_hdrs),
-            *blobs_with_pad)
+        return directory, tables
 
-        full_checksum = _otf_table_checksum(pre_full_checksum)
-        head_blob = self._head.pack(checksum=(0x1b1b0afba - full_checksum) & 0xffffffff)
+    def save(self):
+        if self.stats is not None:
+            start = _clock()
+
+        directory, tables = self._layout()
+        r = rope(directory, *(part for blob, source_offset in tables for part in (blob, _pad4(len(blob)))))
+
+        if self.stats is not None:
+            self.stats._saved(len(r), _clock() - start)
+        return r
+
+    def write_to(self, fout):
+        '''
+        Writes the font to the file object `fout` and returns the number of
+        bytes written. Tables are streamed without assembling the font in
+        memory; when both the font's source and `fout` are regular files,
+        unmodified tables are copied by the kernel.
+        '''
+
+        if self.stats is not None:
+            start = _clock()
+
+        directory, tables = self._layout()
+
+        source_fd = _fileno(self._source_file)
+        dest_fd = _fileno(fout) if source_fd is not None else None
+
+        # The font needn't start at the beginning of `fout`; kernel copies
+        # go to absolute file offsets.
+        base = fout.tell() if dest_fd is not None else 0
+
+        fout.write(directory)
+        pos = len(directory)
+        for blob, source_offset in tables:
+            if source_offset is None or dest_fd is None or not _copy_range(source_fd, fout, dest_fd, source_offset, len(blob), base + pos):
+                for chunk in rope(blob).chunks:
+                    fout.write(chunk)
+            fout.write(_pad4(len(blob)))
+            pos += _align4(len(blob))
+
+        if self.stats is not None:
+            self.stats._saved(pos, _clock() - start)
+        return pos
+
+class FontCollection:
+    '''
+    A TrueType/OpenType collection. Each face is an `OpenTypeFont`; faces
+    whose directories point at the same table share the parsed table
+    object, and `save` writes such tables only once.
+    '''
+
+    def __init__(self, fonts):
+        self.fonts = fonts
+        self._source_file = None
+        self._owns_source = False
+        self._mmap = None
+
+    @staticmethod
+    def parse(fin, cache=None):
+        fin.seek(0)
+        hdr = _TTC_HEADER.parse(fin)
+        if hdr.ttcTag != b'ttcf':
+            raise RuntimeError('not a font collection')
 
-        return rope(pre_full_checksum[:head_offset], head_blob, pre_full_checksum[head_offset + len(head_blob):])
+        offsets = read_array(fin.read(4 * hdr.numFonts), 0, hdr.numFonts, 'I')
+
+        fonts = []
+        shared = {}
+        blob = grope.wrap_io(fin)
+        for offset in offsets:
+            fin.seek(offset)
+            face_hdr = _OTF_OFFSET_TABLE.parse(fin)
+            directory = fin.read(_OTF_TABLE_RECORD.size * face_hdr.numTables)
+            fonts.append(OpenTypeFont._from_directory(_unpack_directory(directory, 0, face_hdr.numTables), blob, fin, shared, cache))
+
+        collection = FontCollection(fonts)
+        collection._source_file = fin
+        return collection
+
+    @staticmethod
+    def open(path, mmap=True, cache=None):
+        fin = open(path, 'rb')
+        try:
+            if not mmap:
+                collection = FontCollection.parse(fin, cache)
+            else:
+                mapping = _mmap.mmap(fin.fileno(), 0, access=_mmap.ACCESS_READ)
+                blob = memoryview(mapping)
+
+                hdr = _TTC_HEADER.parse_blob(blob)
+                if hdr.ttcTag != b'ttcf':
+                    raise RuntimeError('not a font collection')
+                offsets = read_array(blob, _TTC_HEADER.size, hdr.numFonts, 'I')
+
+                fonts = []
+                shared = {}
+                for offset in offsets:
+                    face_hdr = _OTF_OFFSET_TABLE.parse_blob(blob[offset:])
+                    table_hdrs = _unpack_directory(blob, offset + _OTF_OFFSET_TABLE.size, face_hdr.numTables)
+                    fonts.append(OpenTypeFont._from_directory(table_hdrs, blob, fin, shared, cache))
+
+                collection = FontCollection(fonts)
+                collection._source_file = fin
+                collection._mmap = mapping
+
+            collection._owns_source = True
+            return collection
+        except:
+            fin.close()
+            raise
+
+    def close(self):
+        for font in self.fonts:
+            font.close()
+        self.fonts = []
+
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass
+            self._mmap = None
+
+        if self._source_file is not None and self._owns_source:
+            self._source_file.close()
+        self._source_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.fonts)
+
+    def __getitem__(self, idx):
+        return self.fonts[idx]
+
+    def __iter__(self):
+        return iter(self.fonts)
+
+    def save(self):
+        for font in self.fonts:
+            font.get(b'head')
+            font._sync_shared()
+
+        hdr = _TTC_HEADER(ttcTag=b'ttcf', majorVersion=1, minorVersion=0, numFonts=len(self.fonts))
+
+        face_offsets = []
+        data_offset = _TTC_HEADER.size + 4 * len(self.fonts)
+        for font in self.fonts:
+            face_offsets.append(data_offset)
+            data_offset += _OTF_OFFSET_TABLE.size + _OTF_TABLE_RECORD.size * len(font._tables)
+
+        # Tables are laid out after all the directories, each distinct table
+        # once. After `_sync_shared`, a table still unparsed is identified by
+        # its offset in the source, a parsed one by the object itself.
+        def key(font, tab):
+            offset = font._source_offsets.get(tab.name)
+            if isinstance(tab, OtfUnparsedTable) and offset is not None:
+                return tab.name, offset
+            return id(tab)
+
+        placed = {}
+        blobs = []
+        for font in self.fonts:
+            for tab in font._tables:
+                if key(font, tab) in placed:
+                    continue
+                blob, checksum, source_offset = font._table_data(tab)
+                placed[key(font, tab)] = len(blobs), data_offset, checksum
+                blobs.append(blob)
+                data_offset += _align4(len(blob))
+
+        directories = []
+        adjusted = set()
+        for font in self.fonts:
+            records = []
+            for tab in font._tables:
+                idx, offset, checksum = placed[key(font, tab)]
+                records.append((tab.name, checksum, offset, len(blobs[idx])))
+            directory = font._directory(records)
+            directories.append(directory)
+
+            # The checksum adjustment is computed as if the face was a font
+            # file of its own; a head table shared between faces gets the
+            # value of the first face.
+            idx = placed[key(font, font.get(b'head'))][0]
+            if idx not in adjusted:
+                adjusted.add(idx)
+                full_checksum = _otf_table_checksum(directory) + sum(checksum for tag, checksum, offset, length in records)
+                blobs[idx] = font.get(b'head').pack(checksum=(0x1b1b0afba - full_checksum) & 0xffffffff)
+
+        return rope(hdr.pack(), struct.pack('>{}I'.format(len(face_offsets)), *face_offsets), *directories,
+            *(part for blob in blobs for part in (blob, _pad4(len(blob)))))
@@ -0,0 +1,128 @@
+import time, collections
+
+_clock = time.perf_counter
+
+class SubtableStats:
+    __slots__ = ('calls', 'hits', 'seconds')
+
+    def __init__(self):
+        self.calls = 0
+        self.hits = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return 'SubtableStats(calls={}, hits={}, seconds={})'.format(self.calls, self.hits, self.seconds)
+
+class Stats:
+    '''
+    Collects timings and counters of a font while enabled with
+    `OpenTypeFont.enable_stats`: table parse times, the number of shaping
+    calls and glyphs, and for each GSUB subtable the number of times it was
+    consulted (its coverage matched), the number of times it substituted
+    and the time spent in it. Fonts without stats run uninstrumented code.
+
+    If given, `callback(event, info)` is called after every parse, shape
+    and save with a dict describing it.
+    '''
+
+    def __init__(self, callback=None):
+        self.callback = callback
+
+        self.parse_seconds = collections.Counter()
+        self.shape_calls = 0
+        self.shape_seconds = 0.0
+        self.glyphs = 0
+        self.subtables = {}
+        self.saves = 0
+        self.save_bytes = 0
+        self.save_seconds = 0.0
+
+    def _event(self, event, **info):
+        if self.callback is not None:
+            self.callback(event, info)
+
+    def _parsed(self, tag, seconds):
+        self.parse_seconds[tag] += seconds
+        self._event('parse', table=tag, seconds=seconds)
+
+    def _saved(self, nbytes, seconds):
+        self.saves += 1
+        self.save_bytes += nbytes
+        self.save_seconds += seconds
+        self._event('save', bytes=nbytes, seconds=seconds)
+
+    def _shape(self, shape, gids):
+        start = _clock()
+        buf = shape(gids)
+        seconds = _clock() - start
+
+        self.shape_calls += 1
+        self.shape_seconds += seconds
+        self.glyphs += buf.pos
+        self._event('shape', glyphs=buf.pos, seconds=seconds)
+        return buf
+
+    def _wrap_subtable(self, lookup_idx, subtable_idx, subtable):
+        stats = self.subtables.get((lookup_idx, subtable_idx))
+        if stats is None:
+            stats = self.subtables[lookup_idx, subtable_idx] = SubtableStats()
+
+        def counted(buf):
+            cur, pos = buf.cur, buf.pos
+            start = _clock()
+            subtable(buf)
+            stats.seconds += _clock() - start
+            stats.calls += 1
+            if buf.cur != cur or buf.pos != pos:
+                stats.hits += 1
+
+        counted.coverage = subtable.coverage
+        return counted
+
+    def lookups(self):
+        '''
+        Returns the subtable stats summed up by lookup index.
+        '''
+
+        r = {}
+        for (lookup_idx, subtable_idx), stats in self.subtables.items():
+            total = r.get(lookup_idx)
+            if total is None:
+                total = r[lookup_idx] = SubtableStats()
+            total.calls += stats.calls
+            total.hits += stats.hits
+            total.seconds += stats.seconds
+        return r
+
+    def coverage_ratio(self, lookup_idx):
+        '''
+        Returns the fraction of the shaped glyphs the lookup's coverage
+        matched.
+        '''
+
+        if not self.glyphs:
+            return 0.0
+        return sum(stats.calls for (idx, subtable_idx), stats in self.subtables.items() if idx == lookup_idx) / float(self.glyphs)
+
+    def as_dict(self):
+        def subtable_dict(stats):
+            return { 'calls': stats.calls, 'hits': stats.hits, 'seconds': stats.seconds }
+
+        return {
+            'parse_seconds': { tag.decode('ascii'): seconds for tag, seconds in self.parse_seconds.items() },
+            'shape': { 'calls': self.shape_calls, 'glyphs': self.glyphs, 'seconds': self.shape_seconds },
+            'lookups': { idx: dict(subtable_dict(stats), coverage_ratio=self.coverage_ratio(idx)) for idx, stats in self.lookups().items() },
+            'subtables': { '{}.{}'.format(*key): subtable_dict(stats) for key, stats in self.subtables.items() },
+            'save': { 'calls': self.saves, 'bytes': self.save_bytes, 'seconds': self.save_seconds },
+            }
+
+    def reset(self):
+        callback = self.callback
+        subtables = self.subtables
+        self.__init__(callback)
+
+        # Compiled subbers hold on to these, they are zeroed in place.
+        self.subtables = subtables
+        for stats in subtables.values():
+            stats.calls = stats.hits = 0
+            stats.seconds = 0.0
@@ -1,4 +1,4 @@
-import struct
+import struct, array, sys
 
 def struct_le(fn, *entries):
     return _struct(fn, entries, endian='<')
@@ -11,20 +11,35 @@ def parse(fin, fmt):
     s = fin.read(size)
     return struct.unpack(fmt, s)
 
-def parse_array(fin, fmt, count):
-    size_one = struct.calcsize(fmt)
-
-    r = []
-
-    fmt_templ = fmt[0] + '{}' + fmt[1:]
-    while count:
-        chunk = min(count, 16*1024)
-        s = fin.read(size_one * chunk)
-        r.extend(struct.unpack(fmt_templ.format(chunk), s))
-        count -= chunk
-
+def parse_at(blob, offset, fmt):
+    buf, offset = _buffer(blob, offset, struct.calcsize(fmt))
+    return struct.unpack_from(fmt, buf, offset)
+
+def read_array(blob, offset, count, typecode='H', endian='>'):
+    '''
+    Reads `count` items at `offset` into an `array.array` of `typecode`,
+    swapping the bytes in bulk if `endian` differs from the host's. The
+    items are copied straight from the blob's buffer when it has one.
+    '''
+
+    r = array.array(typecode)
+    size = count * r.itemsize
+    buf, offset = _buffer(blob, offset, size)
+    if offset + size > len(buf):
+        raise RuntimeError('premature end of data')
+
+    r.frombytes(memoryview(buf)[offset:offset + size])
+    if (endian == '>') != (sys.byteorder == 'big'):
+        r.byteswap()
     return r
 
+def _buffer(blob, offset, size):
+    # `unpack_from` needs an object exposing the buffer interface, ropes
+    # and other blobs are copied out.
+    if isinstance(blob, (bytes, bytearray, memoryview)):
+        return blob, offset
+    return bytes(blob[offset:offset + size]), 0
+
 def _struct(fn, entries, endian):
     fmt_string = [endian]
     names = []
@@ -40,61 +55,70 @@ def _struct(fn, entries, endian):
         fmt_string.append(fmt)
         names.append(name)
 
-    _fmt = ''.join(fmt_string)
-    _names = names
-    _size = struct.calcsize(_fmt)
+    _names = tuple(names)
+    _st = struct.Struct(''.join(fmt_string))
+    _size = _st.size
+    _unpack_from = _st.unpack_from
+    _old_init = fn.__dict__.get('__init__')
+
+    # The constructor and the tuple-to-record conversion assign all fields
+    # in a single statement, the code is generated for each struct much
+    # like `collections.namedtuple` does.
+    fields = ', '.join('self.{}'.format(name) for name in _names)
+    src = """
+def __init__(self, {args}):
+    {fields}{comma} = {names}{comma}
+    if _old_init is not None:
+        _old_init(self)
 
-    @classmethod
-    def parse_blob(cls, blob):
-        r = cls()
-        toks = struct.unpack(_fmt, bytes(blob[:_size]))
-        for tok, name in zip(toks, _names):
-            setattr(r, name, tok)
-        return r
+def _make(toks):
+    self = _new(cls)
+    {fields}{comma} = toks
+    return self
+""".format(args=', '.join('{}=None'.format(name) for name in _names), fields=fields, names=', '.join(_names),
+        comma=',' if len(_names) == 1 else '')
 
-    @classmethod
-    def parse(cls, fin):
-        chunks = []
-        to_read = _size
-        while to_read:
-           s = fin.read(to_read)
-           if not s:
-               raise RuntimeError('premature end of file')
-           to_read -= len(s)
-           chunks.append(s)
-
-        r = cls()
-        toks = struct.unpack(_fmt, b''.join(chunks))
-        for tok, name in zip(toks, _names):
-            setattr(r, name, tok)
-        return r
-
-        return parse_blob(grope.wrap_file(fin))
+    ns = { k: v for k, v in fn.__dict__.items() if k not in ('__dict__', '__weakref__') }
+    ns['__slots__'] = _names
+    cls = type(fn.__name__, tuple(base for base in fn.__bases__ if base is not object) or (object,), ns)
 
-    def pack(self):
-        return struct.pack(_fmt, *(getattr(self, name) for name in _names))
+    env = { '_old_init': _old_init, '_new': object.__new__, 'cls': cls }
+    exec(src, env)
+    _make = env['_make']
 
-    _old_init = fn.__init__
+    @classmethod
+    def parse_blob(cls, blob, offset=0):
+        return _make(_unpack_from(*_buffer(blob, offset, _size)))
 
-    def __init__(self, **kw):
-        for k in kw:
-            if k not in _names:
-                raise AttributeError('struct has no attribute {}'.format(k))
-            setattr(self, k, kw[k])
+    @classmethod
+    def parse_many(cls, blob, offset, count):
+        size = _size * count
+        buf, offset = _buffer(blob, offset, size)
+        if offset + size > len(buf):
+            raise RuntimeError('premature end of data')
+        return [_make(toks) for toks in _st.iter_unpack(memoryview(buf)[offset:offset + size])]
 
-        for name in _names:
-            if name not in kw:
-                setattr(self, name, None)
+    @classmethod
+    def parse(cls, fin):
+        s = fin.read(_size)
+        while len(s) < _size:
+            chunk = fin.read(_size - len(s))
+            if not chunk:
+                raise RuntimeError('premature end of file')
+            s += chunk
+        return _make(_unpack_from(s))
 
-        _old_init(self)
+    def pack(self):
+        return _st.pack(*(getattr(self, name) for name in _names))
 
     def __repr__(self):
         return '{}({})'.format(type(self).__name__, ', '.join('{}={}'.format(name, getattr(self, name)) for name in _names))
 
-    fn.parse = parse
-    fn.parse_blob = parse_blob
-    fn.pack = pack
-    fn.size = _size
-    fn.__init__ = __init__
-    fn.__repr__ = __repr__
-    return fn
+    cls.parse = parse
+    cls.parse_blob = parse_blob
+    cls.parse_many = parse_many
+    cls.pack = pack
+    cls.size = _size
+    cls.__init__ = env['__init__']
+    cls.__repr__ = __repr__
+    return cls
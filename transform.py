@@ -1,36 +1,177 @@
-import sys, grope, argparse, six, math, os
+import sys, argparse, os, glob, time, string, tempfile, collections
+import concurrent.futures
 from otf_tools import OpenTypeFont
 
+_font_exts = ('.otf', '.ttf')
+
+# Outputs are created through `mkstemp`, which makes them private; they
+# get the permissions a plain `open` would have given them.
+_umask = os.umask(0)
+os.umask(_umask)
+
+def transform(font):
+    cmap = font.get(b'cmap')
+    cmap.remap_codepoints([ord(ch) + 1 for ch in string.ascii_lowercase], string.ascii_lowercase)
+
+def _is_font(path, suffix):
+    base, ext = os.path.splitext(path)
+    # Outputs written next to their inputs must not be picked up on the next
+    # run; `suffix` is None when they go to an output directory instead.
+    return ext.lower() in _font_exts and not (suffix and base.endswith(suffix))
+
+def _glob_root(pattern):
+    # The leading directories of `pattern` that contain no wildcards.
+    parts = []
+    head = os.path.dirname(pattern)
+    while head and head != os.path.dirname(head):
+        head, tail = os.path.split(head)
+        parts.append(tail)
+    root = head
+    for part in reversed(parts):
+        if glob.has_magic(part):
+            break
+        root = os.path.join(root, part)
+    return root
+
+def _expand(inputs, suffix):
+    '''
+    Yields (path, relative path) for each font named by `inputs`, which may
+    be files, directories (searched recursively) or glob patterns. The
+    relative path is where the output goes below the output directory.
+    '''
+
+    for input in inputs:
+        if os.path.isdir(input):
+            for root, dirs, files in os.walk(input):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    if _is_font(path, suffix):
+                        yield path, os.path.relpath(path, input)
+        elif glob.has_magic(input):
+            root = _glob_root(input)
+            for path in sorted(glob.glob(input, recursive=True)):
+                if os.path.isfile(path) and _is_font(path, suffix):
+                    yield path, os.path.relpath(path, root or os.curdir)
+        else:
+            yield input, os.path.basename(input)
+
+def _output_path(path, relpath, output_dir, suffix):
+    if output_dir is None:
+        base, ext = os.path.splitext(path)
+        return '{}{}{}'.format(base, suffix, ext)
+    return os.path.join(output_dir, relpath)
+
+def _process(job):
+    path, output = job
+
+    start = time.perf_counter()
+    tmp = None
+    try:
+        size = os.path.getsize(path)
+        with OpenTypeFont.open(path) as font:
+            transform(font)
+
+            parent = os.path.dirname(output)
+            if parent:
+                os.makedirs(parent, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix=os.path.basename(output) + '.', suffix='.tmp', dir=parent or os.curdir)
+            with os.fdopen(fd, 'wb') as fout:
+                written = font.write_to(fout)
+        os.chmod(tmp, 0o666 & ~_umask)
+        os.replace(tmp, output)
+    except Exception as e:
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+        return path, output, None, _describe(e)
+
+    return path, output, (size, written, time.perf_counter() - start), None
+
+def _describe(e):
+    cls = type(e)
+    name = cls.__name__ if cls.__module__ == 'builtins' else '{}.{}'.format(cls.__module__, cls.__name__)
+    return '{}: {}'.format(name, e)
+
+def _mbps(nbytes, seconds):
+    return nbytes / seconds / 1e6 if seconds > 0 else float('inf')
+
 def _main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument('input', type=argparse.FileType('rb'))
-    ap.add_argument('output', nargs='?')
+    ap = argparse.ArgumentParser(description='Transforms fonts in parallel. Inputs may be font files, directories or glob patterns.')
+    ap.add_argument('inputs', nargs='+')
+    ap.add_argument('--output-dir', '-o', help='write outputs here, mirroring the layout of input directories; by default they go next to the inputs')
+    ap.add_argument('--suffix', default='-out', help='appended to the output names when writing next to the inputs (default: %(default)s)')
+    ap.add_argument('--workers', '-j', type=int, default=os.cpu_count() or 1, help='number of worker processes (default: %(default)s)')
+    ap.add_argument('--quiet', '-q', action='store_true', help='only report failures and the total')
     args = ap.parse_args()
 
-    if not args.output:
-        base, ext = os.path.splitext(args.input.name)
-        args.output = '{}-out{}'.format(base, ext)
-    
-    font = OpenTypeFont.parse(args.input)
+    if args.output_dir is None and not args.suffix:
+        ap.error('--suffix must not be empty when writing next to the inputs')
 
+    inputs = _expand(args.inputs, args.suffix if args.output_dir is None else None)
+    jobs = [(path, _output_path(path, relpath, args.output_dir, args.suffix)) for path, relpath in inputs]
+    if not jobs:
+        print('no fonts found', file=sys.stderr)
+        return 2
 
-    glyphs = font.get_glyphs('1 != 0')
-    s = font.inv_glyphs([68, 210, 987])
+    # A font named twice, e.g. by a directory and a glob, is done once.
+    unique = collections.OrderedDict()
+    for path, output in jobs:
+        unique.setdefault(os.path.realpath(path), (path, output))
+    jobs = list(unique.values())
 
-    gsub = font.gsub()
+    # Fonts whose outputs would overwrite each other, or an input, fail
+    # before anything is written.
+    writers = collections.defaultdict(list)
+    for path, output in jobs:
+        writers[os.path.realpath(output)].append(path)
+    conflicts = {}
+    for path, output in jobs:
+        key = os.path.realpath(output)
+        if key in unique:
+            conflicts[path, output] = 'the output {} is one of the inputs'.format(output)
+        elif len(writers[key]) > 1:
+            conflicts[path, output] = 'the output {} would also be written for {}'.format(output, ', '.join(other for other in writers[key] if other != path))
 
-    cmap = font.get(b'cmap')
+    start = time.perf_counter()
+    done = failed = total_in = total_out = 0
+
+    def report(path, output, result, error):
+        nonlocal done, failed, total_in, total_out
+        if error is not None:
+            failed += 1
+            print('{}: error: {}'.format(path, error), file=sys.stderr)
+            return
+
+        size, written, seconds = result
+        done += 1
+        total_in += size
+        total_out += written
+        if not args.quiet:
+            print('{} -> {}: {} bytes in {:.1f} ms ({:.1f} MB/s)'.format(path, output, written, seconds * 1000, _mbps(size, seconds)))
 
-    import string
-    for ch in string.ascii_lowercase:
-        cmap[ch] = cmap[chr(ord(ch) + 1)]
+    for (path, output), error in conflicts.items():
+        report(path, output, None, error)
+    jobs = [job for job in jobs if job not in conflicts]
 
-    out_blob = font.save()
+    if args.workers <= 1:
+        for job in jobs:
+            report(*_process(job))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+            futures = { executor.submit(_process, job): job for job in jobs }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    report(*future.result())
+                except Exception as e:
+                    # The worker itself died, e.g. it was killed or ran out of memory.
+                    path, output = futures[future]
+                    report(path, output, None, _describe(e))
 
-    with open(args.output, 'wb') as fout:
-        grope.dump(out_blob, fout)
+    elapsed = time.perf_counter() - start
+    print('{} fonts, {} failed, {} -> {} bytes in {:.2f} s ({:.1f} MB/s, {:.1f} fonts/s)'.format(
+        done + failed, failed, total_in, total_out, elapsed, _mbps(total_in, elapsed), (done + failed) / elapsed if elapsed > 0 else 0.0))
 
-    return 0
+    return 1 if failed else 0
 
 if __name__ == '__main__':
     sys.exit(_main())